@@ -1,17 +1,23 @@
 from __future__ import annotations
 
+import mmap
+import os
 import socket
 import struct
-from random import randbytes
+from collections.abc import Iterable
 
 from datagram import Datagram, TCPFlag
+from transport import Transport, udp_transport
+
+_MSS = 1024 - Datagram.HEADER_SIZE  # the peer reads whole datagrams into 1024 byte buffers
 
 
 class TCPConnector:
 
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, transport: Transport = udp_transport):
         self.host = host
         self.port = port
+        self._transport = transport
         self._socket: socket.socket = None
         self._server_addr: tuple[str, int] = tuple()
         self._seq_number: int = 0
@@ -19,13 +25,13 @@ class TCPConnector:
 
     def connect(self, addr: tuple[str, int]) -> TCPConnection:
         self._server_addr = addr
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket = self._transport.socket()
         self._socket.bind((self.host, self.port))
 
         try:
             self._request_syn()
             resp = self._await_syn_ack()
-            final_ack_datagram = self._ack(resp)
+            self._ack(resp)
         except Exception:
             self._socket.close()
             raise
@@ -35,13 +41,12 @@ class TCPConnector:
             addr=(self.host, self.port),
             remote_addr=(self._server_addr[0], resp.source_port),
             seq_number=self._seq_number,
-            ack_number=self._ack_number,
-            final_ack_datagram=final_ack_datagram
+            ack_number=self._ack_number
         )
 
     def _request_syn(self):
         print("SYN request")
-        self._seq_number = int(struct.unpack('I', randbytes(4))[0])  # 32bit int
+        self._seq_number = int(struct.unpack('I', self._transport.randbytes(4))[0])  # 32bit int
         print(f"server's seq number: {self._seq_number}")
         syn_datagram = Datagram(
             source_port=self.port,
@@ -94,9 +99,10 @@ class TCPConnector:
 
 class TCPListener:
 
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, transport: Transport = udp_transport):
         self.host = host
         self.port = port
+        self._transport = transport
         self._client_addr: tuple[str, int] = tuple()
         self._seq_number: int = 0
         self._ack_number: int = 0
@@ -105,7 +111,7 @@ class TCPListener:
         self._syn_datagram: Datagram = None
 
     def listen(self) -> None:
-        self._wcm_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # keep open for other connections
+        self._wcm_socket = self._transport.socket()  # keep open for other connections
         self._wcm_socket.bind((self.host, self.port))
         self._wcm_socket.settimeout(1.0)
 
@@ -132,12 +138,12 @@ class TCPListener:
             self._wcm_socket.close()
 
     def accept(self) -> TCPConnection:
-        self._conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._conn = self._transport.socket()
         self._conn.bind((self.host, 0))  # assign random socket
         self._conn.settimeout(1.0)
         _, conn_port = self._conn.getsockname()
 
-        self._seq_number = int(struct.unpack('I', randbytes(4))[0])  # 32bit int
+        self._seq_number = int(struct.unpack('I', self._transport.randbytes(4))[0])  # 32bit int
         print(f"client's seq number: {self._seq_number}")
         syn_ack_datagram = Datagram(
             source_port=conn_port,
@@ -165,14 +171,14 @@ class TCPListener:
                 addr=(self.host, self.port),
                 remote_addr=self._client_addr,
                 seq_number=self._seq_number,
-                ack_number=ack_datagram.seq_number,
-                final_ack_datagram=ack_datagram
+                ack_number=ack_datagram.seq_number
             )
 
         raise Exception("Invalid ACK datagram received during handshake")
 
 
 class TCPConnection:
+    MSS = _MSS  # the most payload a segment carries, and so the least `recv_into` must have room for
 
     def __init__(
             self,
@@ -180,59 +186,192 @@ class TCPConnection:
             addr: tuple[str, int],
             remote_addr: tuple[str, int],
             seq_number: int,
-            ack_number: int,
-            final_ack_datagram: Datagram
+            ack_number: int
     ):
         self._socket = sock
         self._addr = addr
         self._rmt_addr = remote_addr
         self._seq_number = seq_number
-        self._ack_number = ack_number
-        self._last_datagram = final_ack_datagram
+        self._ack_number = ack_number  # next SEQ number expected from the peer
 
     def send(self, data: bytes):
-        datagram = Datagram(
+        self._send_segment([data])
+
+    def send_vectored(self, buffers: Iterable[bytes | bytearray | memoryview]) -> int:
+        """
+        Sends the buffers as one contiguous stream without joining them first: each segment is framed
+        from MSS-sized slices of consecutive buffers, the way `socket.sendmsg` takes them.
+        Returns the number of bytes sent.
+        """
+        chunks: list[memoryview] = []
+        free = _MSS
+        sent = 0
+        for buffer in buffers:
+            view = memoryview(buffer).cast('B')
+            pos = 0
+            while pos < len(view):
+                chunk = view[pos:pos + free]
+                chunks.append(chunk)
+                pos += len(chunk)
+                free -= len(chunk)
+                if free == 0:
+                    self._send_segment(chunks)
+                    sent += _MSS
+                    chunks = []
+                    free = _MSS
+
+        if chunks:
+            self._send_segment(chunks)
+            sent += _MSS - free
+
+        return sent
+
+    def sendfile(self, file: str | os.PathLike | int, offset: int = 0, count: int | None = None) -> int:
+        """
+        Sends `count` bytes of the file starting at `offset` (up to the end of the file by default).
+        Segments are sliced straight out of a read-only memory map, so the file is never copied into
+        `bytes`. File descriptors are left open. Returns the number of bytes sent.
+        """
+        if offset < 0 or count is not None and count < 0:
+            raise ValueError(f"offset and count can't be negative, got {offset=}, {count=}")
+
+        fd = file if isinstance(file, int) else os.open(file, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            count = size - offset if count is None else min(count, size - offset)
+            if count <= 0:
+                return 0
+
+            map_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+            start = offset - map_offset
+            end = start + count
+            with mmap.mmap(fd, end, access=mmap.ACCESS_READ, offset=map_offset) as mm, memoryview(mm) as view:
+                for pos in range(start, end, _MSS):
+                    with view[pos:min(pos + _MSS, end)] as segment:
+                        self._send_segment([segment])
+        finally:
+            if not isinstance(file, int):
+                os.close(fd)
+
+        return count
+
+    def recv(self, buff_size: int) -> bytes:
+        msg = self._socket.recv(buff_size)
+        datagram = Datagram.unpack(msg)
+        self._ack_segment(datagram)
+        return datagram.data
+
+    def recv_into(self, buffer: bytearray | memoryview) -> int:
+        """
+        Receives one segment straight into `buffer`, returns the number of bytes written.
+        `buffer` must have room for `MSS` bytes, a segment is never split across calls.
+        """
+        with memoryview(buffer).cast('B') as view:
+            if len(view) < _MSS:
+                raise ValueError(f"Receive buffer of {len(view)} bytes can't hold a {_MSS} byte segment")
+            return self._recv_segment_into(view)
+
+    def recvfile(self, file: str | os.PathLike | int, count: int, offset: int = 0) -> int:
+        """
+        Receives exactly `count` bytes into the file at `offset`, growing it first if needed.
+        Segments are received directly into a writable memory map of that region.
+        File descriptors are left open. Returns the number of bytes received.
+        """
+        if offset < 0 or count < 0:
+            raise ValueError(f"offset and count can't be negative, got {offset=}, {count=}")
+        if count == 0:
+            return 0
+
+        fd = file if isinstance(file, int) else os.open(file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < offset + count:
+                os.ftruncate(fd, offset + count)
+
+            map_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+            pos = offset - map_offset
+            end = pos + count
+            with mmap.mmap(fd, end, offset=map_offset) as mm:
+                with memoryview(mm) as view:
+                    while pos < end:
+                        with view[pos:end] as buffer:
+                            if len(buffer) >= _MSS:
+                                pos += self._recv_segment_into(buffer)
+                            else:
+                                pos += self._recv_last_segment_into(buffer)
+                mm.flush()
+        finally:
+            if not isinstance(file, int):
+                os.close(fd)
+
+        return count
+
+    def set_timeout(self, value: int | None) -> None:
+        self._socket.settimeout(value)
+
+    def _send_segment(self, chunks: list[bytes | memoryview]) -> None:
+        header = Datagram(
             source_port=self._addr[1],
             destination_port=self._rmt_addr[1],
             seq_number=self._seq_number,
-            ack_number=self._ack_number + _seq_increment(self._last_datagram.flags, self._last_datagram.data),
+            ack_number=self._ack_number,
             flags=TCPFlag.ACK,
-            data=data
-        )
-        self._socket.sendto(datagram.pack(), self._rmt_addr)
-        self._seq_number += _seq_increment(datagram.flags, datagram.data)
+            data=b''  # the payload is in `chunks`, the header doesn't depend on it
+        ).pack_header()
+        # header and payload go out as separate buffers so the payload is never copied into a new bytes
+        self._socket.sendmsg([header, *chunks], [], 0, self._rmt_addr)
+        self._seq_number += sum(len(chunk) for chunk in chunks)  # ACK segments take exactly their payload in SEQ space
 
         msg = self._socket.recv(1024)
         ack_datagram = Datagram.unpack(msg)
         if not (ack_datagram.has_exact_flags(TCPFlag.ACK) and ack_datagram.ack_number == self._seq_number):
             raise Exception("unACKed response from the peer")
 
-        self._last_datagram = ack_datagram
+    def _recv_segment_into(self, buffer: memoryview) -> int:
+        """`buffer` has room for `_MSS` bytes, so a truncated datagram comes from a peer that ignores it."""
+        header = bytearray(Datagram.HEADER_SIZE)
+        nbytes, _, msg_flags, _ = self._socket.recvmsg_into([header, buffer])
+        if msg_flags & socket.MSG_TRUNC:
+            raise Exception("Datagram doesn't fit into the receive buffer")
 
-    def recv(self, buff_size: int) -> bytes:
-        msg = self._socket.recv(buff_size)
-        datagram = Datagram.unpack(msg)
+        if nbytes < Datagram.HEADER_SIZE:
+            raise Exception(f"Malformed datagram of {nbytes} bytes received")
+
+        size = nbytes - Datagram.HEADER_SIZE
+        with buffer[:size] as data:
+            self._ack_segment(Datagram.unpack_header(header, data=data))
+
+        return size
+
+    def _recv_last_segment_into(self, buffer: memoryview) -> int:
+        # too little room left for a whole segment, take it into a scratch one rather than cut it off
+        segment = bytearray(_MSS)
+        with memoryview(segment) as view:
+            size = self._recv_segment_into(view)
+        if size > len(buffer):
+            raise Exception(f"Peer sent {size} bytes, only {len(buffer)} more were expected")
+
+        buffer[:size] = segment[:size]
+        return size
 
+    def _ack_segment(self, datagram: Datagram) -> None:
         if not (datagram.has_exact_flags(TCPFlag.ACK) and datagram.ack_number == self._seq_number):
             raise Exception("unACKed response from the peer")
 
-        self._last_datagram = datagram
+        if datagram.seq_number != self._ack_number:
+            raise Exception(f"Out of order segment - expected SEQ {self._ack_number}, got {datagram.seq_number}")
+
+        self._ack_number += _seq_increment(datagram.flags, datagram.data)
         ack_datagram = Datagram(
             source_port=self._addr[1],
             destination_port=self._rmt_addr[1],
             seq_number=self._seq_number,
-            ack_number=self._ack_number + _seq_increment(self._last_datagram.flags, self._last_datagram.data),
+            ack_number=self._ack_number,
             flags=TCPFlag.ACK,
             data=b''
         )
         self._socket.sendto(ack_datagram.pack(), self._rmt_addr)
         self._seq_number += _seq_increment(ack_datagram.flags, ack_datagram.data)
 
-        return self._last_datagram.data
-
-    def set_timeout(self, value: int | None) -> None:
-        self._socket.settimeout(value)
-
 
 def _seq_increment(flags: TCPFlag, data: bytes) -> int:
     ctrl_flags = TCPFlag.SYN | TCPFlag.FIN
@@ -0,0 +1,444 @@
+"""
+Opt-in capture of every datagram going through sockets wrapped with `wrap()`, plus an offline analyzer.
+
+Captures are pcapng files (LINKTYPE_IPV4, with synthesized IPv4/UDP headers) so tcpdump/Wireshark read them too.
+Every packet is marked as sent or received, so when both peers capture into the same file the analyzer can tell
+the two copies of a datagram apart from a retransmission:
+
+    capture.enable("trace.pcapng")  # or capture.enable(path, clock=network.time) on a SimulatedNetwork
+    ...
+    python capture.py timeline trace.pcapng
+    python capture.py summary trace.pcapng --interval 0.5
+"""
+from __future__ import annotations
+
+import argparse
+import socket
+import struct
+import threading
+import time
+import zlib
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
+
+from datagram import Datagram, TCPFlag
+from tcp_connection.utils import seq_increment
+
+SENT = 'sent'
+RECEIVED = 'received'
+
+_BLOCK_HEADER_FORMAT = '<II'  # block type, block total length
+_BLOCK_HEADER_SIZE = struct.calcsize(_BLOCK_HEADER_FORMAT)
+_SECTION_HEADER_BLOCK = 0x0a0d0d0a
+_SECTION_HEADER_FORMAT = '<IHHq'  # byte order magic, major, minor, section length
+_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+_INTERFACE_DESCRIPTION_BLOCK = 0x00000001
+_INTERFACE_DESCRIPTION_FORMAT = '<HHI'  # link type, reserved, snaplen
+_ENHANCED_PACKET_BLOCK = 0x00000006
+_ENHANCED_PACKET_FORMAT = '<IIIII'  # interface id, timestamp high, timestamp low, captured length, original length
+_ENHANCED_PACKET_SIZE = struct.calcsize(_ENHANCED_PACKET_FORMAT)
+_OPTION_FORMAT = '<HH'  # option code, option length
+_OPTION_SIZE = struct.calcsize(_OPTION_FORMAT)
+_EPB_FLAGS_OPTION = 2
+_EPB_DIRECTIONS = {RECEIVED: 0b01, SENT: 0b10}  # the low bits of epb_flags, inbound and outbound
+_LINKTYPE_IPV4 = 228
+_SNAPLEN = 65535
+_TIMESTAMP_UNITS = 1_000_000  # the default if_tsresol, microseconds
+
+_IP_HEADER_FORMAT = '!BBHHHBBH4s4s'
+_IP_HEADER_SIZE = struct.calcsize(_IP_HEADER_FORMAT)
+_UDP_HEADER_FORMAT = '!HHHH'
+_UDP_HEADER_SIZE = struct.calcsize(_UDP_HEADER_FORMAT)
+
+_recorder: Recorder | None = None
+
+
+class Recorder:
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.clock = clock
+        self._lock = threading.Lock()  # connections record from their own threads
+        self._file = open(path, 'wb')
+        self._file.write(_block(_SECTION_HEADER_BLOCK, struct.pack(_SECTION_HEADER_FORMAT, _BYTE_ORDER_MAGIC, 1, 0, -1)))
+        self._file.write(_block(_INTERFACE_DESCRIPTION_BLOCK, struct.pack(_INTERFACE_DESCRIPTION_FORMAT, _LINKTYPE_IPV4, 0, _SNAPLEN)))
+
+    def __enter__(self) -> Recorder:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def record(self, payload: bytes, src: tuple[str, int], dst: tuple[str, int], direction: str) -> None:
+        """`direction` is SENT or RECEIVED, as seen by the socket that captured the datagram."""
+        timestamp = round(self.clock() * _TIMESTAMP_UNITS)
+        packet = _ipv4_udp_packet(payload, src, dst)
+        padding = b'\0' * (-len(packet) % 4)
+        flags = struct.pack(_OPTION_FORMAT, _EPB_FLAGS_OPTION, 4) + struct.pack('<I', _EPB_DIRECTIONS[direction])
+        end_of_options = struct.pack(_OPTION_FORMAT, 0, 0)
+        body = struct.pack(_ENHANCED_PACKET_FORMAT, 0, timestamp >> 32, timestamp & 0xffffffff, len(packet), len(packet))
+        with self._lock:
+            self._file.write(_block(_ENHANCED_PACKET_BLOCK, body + packet + padding + flags + end_of_options))
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def enable(path: str, clock: Callable[[], float] = time.time) -> Recorder:
+    global _recorder
+    disable()
+    _recorder = Recorder(path, clock=clock)
+    return _recorder
+
+
+def disable() -> None:
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
+
+
+def wrap(sock: socket.socket) -> socket.socket:
+    """Returns `sock` as is unless capturing is enabled."""
+    if _recorder is None:
+        return sock
+
+    return _CapturingSocket(sock, _recorder)
+
+
+class _CapturingSocket:
+
+    def __init__(self, sock: socket.socket, recorder: Recorder):
+        self._sock = sock
+        self._recorder = recorder
+
+    def __getattr__(self, name: str):
+        return getattr(self._sock, name)
+
+    def sendto(self, data: bytes, addr: tuple[str, int]) -> int:
+        sent = self._sock.sendto(data, addr)
+        self._recorder.record(bytes(data), self._sock.getsockname(), addr, SENT)
+        return sent
+
+    def sendmsg(self, buffers, ancdata=(), flags: int = 0, address: tuple[str, int] | None = None) -> int:
+        buffers = list(buffers)
+        sent = self._sock.sendmsg(buffers, ancdata, flags, address)
+        self._recorder.record(b''.join(buffers), self._sock.getsockname(), address, SENT)
+        return sent
+
+    def recv(self, bufsize: int) -> bytes:
+        payload, _ = self.recvfrom(bufsize)
+        return payload
+
+    def recvfrom(self, bufsize: int) -> tuple[bytes, tuple[str, int]]:
+        payload, addr = self._sock.recvfrom(bufsize)
+        self._recorder.record(payload, addr, self._sock.getsockname(), RECEIVED)
+        return payload, addr
+
+    def recvmsg_into(self, buffers, ancbufsize: int = 0, flags: int = 0):
+        buffers = list(buffers)
+        nbytes, ancdata, msg_flags, addr = self._sock.recvmsg_into(buffers, ancbufsize, flags)
+
+        payload = bytearray()
+        for buffer in buffers:
+            if len(payload) >= nbytes:
+                break
+            payload += memoryview(buffer)[:nbytes - len(payload)]
+        self._recorder.record(bytes(payload), addr, self._sock.getsockname(), RECEIVED)
+
+        return nbytes, ancdata, msg_flags, addr
+
+
+def _block(block_type: int, body: bytes) -> bytes:
+    total_length = _BLOCK_HEADER_SIZE + len(body) + 4  # + the trailing copy of the total length
+    return struct.pack(_BLOCK_HEADER_FORMAT, block_type, total_length) + body + struct.pack('<I', total_length)
+
+
+def _ipv4_udp_packet(payload: bytes, src: tuple[str, int], dst: tuple[str, int]) -> bytes:
+    total_length = _IP_HEADER_SIZE + _UDP_HEADER_SIZE + len(payload)
+    src_ip, dst_ip = _ip_bytes(src[0]), _ip_bytes(dst[0])
+    ip_header = struct.pack(_IP_HEADER_FORMAT, 0x45, 0, total_length, 0, 0x4000, 64, socket.IPPROTO_UDP, 0, src_ip, dst_ip)
+    ip_header = ip_header[:10] + struct.pack('!H', _checksum(ip_header)) + ip_header[12:]
+    udp_header = struct.pack(_UDP_HEADER_FORMAT, src[1], dst[1], _UDP_HEADER_SIZE + len(payload), 0)  # no UDP checksum
+    return ip_header + udp_header + payload
+
+
+@lru_cache(maxsize=None)
+def _ip_bytes(host: str) -> bytes:
+    try:
+        return socket.inet_aton(socket.gethostbyname(host))
+    except OSError:
+        # simulated hosts have made up names, give each a stable address in 10.0.0.0/8
+        return b'\x0a' + zlib.crc32(host.encode()).to_bytes(4, 'big')[1:]
+
+
+def _checksum(header: bytes) -> int:
+    total = sum(struct.unpack(f'!{len(header) // 2}H', header))
+    while total > 0xffff:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+@dataclass(frozen=True)
+class Record:
+    timestamp: float
+    src: tuple[str, int]
+    dst: tuple[str, int]
+    datagram: Datagram
+    direction: str | None = None  # SENT or RECEIVED, None when unknown
+    received_at: float | None = None  # set by flows() when the receiving peer's copy was captured too
+
+
+def read_records(path: str) -> Iterator[Record]:
+    with open(path, 'rb') as f:
+        header = f.read(_BLOCK_HEADER_SIZE + struct.calcsize(_SECTION_HEADER_FORMAT))
+        block_type, _ = struct.unpack_from(_BLOCK_HEADER_FORMAT, header)
+        byte_order_magic, = struct.unpack_from('<I', header, _BLOCK_HEADER_SIZE)
+        if block_type != _SECTION_HEADER_BLOCK or byte_order_magic != _BYTE_ORDER_MAGIC:
+            raise Exception(f"{path} is not a little endian pcapng file")
+        f.seek(0)
+
+        while block_header := f.read(_BLOCK_HEADER_SIZE):
+            block_type, total_length = struct.unpack(_BLOCK_HEADER_FORMAT, block_header)
+            body = f.read(total_length - _BLOCK_HEADER_SIZE)[:-4]  # without the trailing total length
+
+            if block_type == _INTERFACE_DESCRIPTION_BLOCK:
+                linktype, _, _ = struct.unpack_from(_INTERFACE_DESCRIPTION_FORMAT, body)
+                if linktype != _LINKTYPE_IPV4:
+                    raise Exception(f"Unsupported link type {linktype}, expected LINKTYPE_IPV4")
+
+            elif block_type == _ENHANCED_PACKET_BLOCK:
+                _, ts_high, ts_low, captured_length, _ = struct.unpack_from(_ENHANCED_PACKET_FORMAT, body)
+                packet = body[_ENHANCED_PACKET_SIZE:_ENHANCED_PACKET_SIZE + captured_length]
+                options = body[_ENHANCED_PACKET_SIZE + captured_length + (-captured_length % 4):]
+                yield _parse_packet(((ts_high << 32) | ts_low) / _TIMESTAMP_UNITS, packet, _direction(options))
+
+
+def _direction(options: bytes) -> str | None:
+    pos = 0
+    while pos + _OPTION_SIZE <= len(options):
+        code, length = struct.unpack_from(_OPTION_FORMAT, options, pos)
+        if code == 0:
+            break
+        if code == _EPB_FLAGS_OPTION:
+            flags, = struct.unpack_from('<I', options, pos + _OPTION_SIZE)
+            for direction, bits in _EPB_DIRECTIONS.items():
+                if flags & 0b11 == bits:
+                    return direction
+        pos += _OPTION_SIZE + length + (-length % 4)
+
+    return None
+
+
+def _parse_packet(timestamp: float, packet: bytes, direction: str | None) -> Record:
+    ip_header_size = (packet[0] & 0x0f) * 4
+    src_ip, dst_ip = packet[12:16], packet[16:20]
+    src_port, dst_port, _, _ = struct.unpack_from(_UDP_HEADER_FORMAT, packet, ip_header_size)
+    return Record(
+        timestamp=timestamp,
+        src=(socket.inet_ntoa(src_ip), src_port),
+        dst=(socket.inet_ntoa(dst_ip), dst_port),
+        datagram=Datagram.unpack(packet[ip_header_size + _UDP_HEADER_SIZE:]),
+        direction=direction
+    )
+
+
+@dataclass
+class Flow:
+    """One connection, identified by the hosts and the ports in the datagram headers."""
+    records: list[Record] = field(default_factory=list)
+
+    @property
+    def name(self) -> str:
+        first = self.records[0]
+        return f"{_endpoint(first.src[0], first.datagram.source_port)} <-> {_endpoint(first.dst[0], first.datagram.destination_port)}"
+
+
+def flows(records: Iterator[Record], dedupe_window: float = 0.05) -> list[Flow]:
+    """
+    Groups records into connections. When both peers capture into the same file every datagram
+    shows up twice, a received copy within `dedupe_window` seconds of the sent one is dropped and its
+    timestamp kept as the sent one's `received_at`. Copies with the same direction are never paired,
+    they are retransmissions, and neither are records whose direction is unknown.
+    The SYN goes to the welcome port, so it's attached to the flow of the SYN-ACK that ACKs it, along
+    with any retransmissions of it.
+    """
+    all_flows: list[Flow] = []
+    by_key: dict[tuple, Flow] = {}
+    pending_syns: dict[tuple[str, int, int], Flow] = {}  # (client host, client port, ACK number expected)
+    unpaired: dict[tuple, tuple[Flow, int]] = {}  # (datagram, direction) -> flow and index of the record
+
+    for record in records:
+        dgram = record.datagram
+        seen_key = (record.src[0], record.dst[0], dgram.source_port, dgram.destination_port,
+                    dgram.seq_number, dgram.ack_number, dgram.flags, len(dgram.data))
+        if record.direction is not None:
+            # the receiver's copy can be captured first, peers run in threads of their own
+            other = RECEIVED if record.direction == SENT else SENT
+            copy_at = unpaired.pop((seen_key, other), None)
+            if copy_at is not None:
+                kept_in, index = copy_at
+                copy = kept_in.records[index]
+                if abs(record.timestamp - copy.timestamp) <= dedupe_window:
+                    sent, received = (record, copy) if record.direction == SENT else (copy, record)
+                    kept_in.records[index] = replace(sent, received_at=received.timestamp)
+                    continue
+
+        key = _flow_key(record)
+        flow = None
+        if dgram.flags & TCPFlag.SYN and not dgram.flags & TCPFlag.ACK:
+            # a retransmitted SYN expects the same ACK, so it joins the flow of the original
+            syn_key = (record.src[0], dgram.source_port, dgram.seq_number + seq_increment(dgram.flags, dgram.data))
+            flow = pending_syns.get(syn_key)
+            if flow is None:
+                flow = pending_syns[syn_key] = _new_flow(all_flows)
+        else:
+            flow = by_key.get(key)
+            if flow is None and dgram.flags & (TCPFlag.SYN | TCPFlag.ACK) == TCPFlag.SYN | TCPFlag.ACK:  # FOP may be set too
+                flow = pending_syns.pop((record.dst[0], dgram.destination_port, dgram.ack_number), None)
+                if flow is not None:
+                    by_key[_flow_key(flow.records[0])] = flow  # later segments may still use the welcome port
+            if flow is None:
+                flow = _new_flow(all_flows)
+            by_key[key] = flow
+
+        if record.direction is not None:
+            unpaired[(seen_key, record.direction)] = (flow, len(flow.records))
+        flow.records.append(record)
+
+    return all_flows
+
+
+def _flow_key(record: Record) -> tuple:
+    dgram = record.datagram
+    return tuple(sorted([(record.src[0], dgram.source_port), (record.dst[0], dgram.destination_port)]))
+
+
+def _new_flow(all_flows: list[Flow]) -> Flow:
+    flow = Flow()
+    all_flows.append(flow)
+    return flow
+
+
+def rtt_samples(flow: Flow) -> list[tuple[float, float]]:
+    """(time sent, RTT) for every segment ACKed by the peer, skipping retransmitted ones (Karn's algorithm)."""
+    outstanding: dict[tuple[str, int], list[tuple[int, float]]] = defaultdict(list)  # sender -> [(expected ACK, sent at)]
+    retransmitted: set[tuple[str, int, int]] = set()
+    sent: set[tuple[str, int, int]] = set()
+    samples = []
+
+    for record in flow.records:
+        dgram = record.datagram
+        sender = (record.src[0], dgram.source_port)
+        receiver = (record.dst[0], dgram.destination_port)
+
+        if dgram.flags & TCPFlag.ACK:
+            pending = outstanding[receiver]
+            while pending and pending[0][0] <= dgram.ack_number:
+                expected_ack, sent_at = pending.pop(0)
+                if (*receiver, expected_ack) not in retransmitted:
+                    acked_at = record.received_at if record.received_at is not None else record.timestamp
+                    samples.append((sent_at, acked_at - sent_at))
+
+        increment = seq_increment(dgram.flags, dgram.data)
+        if increment:
+            segment = (*sender, dgram.seq_number)
+            if segment in sent:
+                retransmitted.add((*sender, dgram.seq_number + increment))
+                continue
+            sent.add(segment)
+            outstanding[sender].append((dgram.seq_number + increment, record.timestamp))
+
+    return samples
+
+
+def retransmissions(flow: Flow) -> list[Record]:
+    seen: set[tuple[str, int, int]] = set()
+    result = []
+    for record in flow.records:
+        dgram = record.datagram
+        if not seq_increment(dgram.flags, dgram.data):
+            continue
+
+        segment = (record.src[0], dgram.source_port, dgram.seq_number)
+        if segment in seen:
+            result.append(record)
+        seen.add(segment)
+
+    return result
+
+
+def throughput(flow: Flow, interval: float) -> dict[str, list[int]]:
+    """Payload bytes per `interval` seconds for each sending endpoint."""
+    start = flow.records[0].timestamp
+    buckets: dict[str, list[int]] = {}
+    for record in flow.records:
+        sender = _endpoint(record.src[0], record.datagram.source_port)
+        series = buckets.setdefault(sender, [])
+        index = int((record.timestamp - start) / interval)
+        series.extend([0] * (index + 1 - len(series)))
+        series[index] += len(record.datagram.data)
+
+    return buckets
+
+
+def _endpoint(host: str, port: int) -> str:
+    return f"{host}:{port}"
+
+
+def _print_timeline(flow: Flow) -> None:
+    start = flow.records[0].timestamp
+    print(f"== {flow.name}")
+    for record in flow.records:
+        dgram = record.datagram
+        print(f"{record.timestamp - start:10.6f}  "
+              f"{_endpoint(record.src[0], dgram.source_port):>21} > {_endpoint(record.dst[0], dgram.destination_port):<21}  "
+              f"{dgram.flags.name or 'NONE':<10} seq={dgram.seq_number:<10} ack={dgram.ack_number:<10} len={len(dgram.data)}")
+
+
+def _print_summary(flow: Flow, interval: float) -> None:
+    print(f"== {flow.name}")
+    print(f"duration: {flow.records[-1].timestamp - flow.records[0].timestamp:.6f}s, datagrams: {len(flow.records)}")
+
+    for sender, series in throughput(flow, interval).items():
+        rates = ' '.join(f"{n / interval:.0f}" for n in series)
+        print(f"throughput {sender} (B/s per {interval}s): {rates}")
+
+    retransmitted = retransmissions(flow)
+    bursts: dict[int, int] = defaultdict(int)
+    start = flow.records[0].timestamp
+    for record in retransmitted:
+        bursts[int((record.timestamp - start) / interval)] += 1
+    print(f"retransmissions: {len(retransmitted)}")
+    for index, count in sorted(bursts.items()):
+        print(f"  {index * interval:.3f}s: {count}")
+
+    samples = [rtt for _, rtt in rtt_samples(flow)]
+    if samples:
+        print(f"RTT samples: {len(samples)}, min {min(samples) * 1000:.3f}ms, "
+              f"avg {sum(samples) / len(samples) * 1000:.3f}ms, max {max(samples) * 1000:.3f}ms")
+    else:
+        print("RTT samples: 0")
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Analyze datagram captures written by capture.Recorder")
+    parser.add_argument('command', choices=['timeline', 'summary'])
+    parser.add_argument('path')
+    parser.add_argument('--interval', type=float, default=1.0, help="bucket size in seconds for throughput and bursts")
+    parser.add_argument('--dedupe-window', type=float, default=0.05,
+                        help="pair the sent and received copies of a datagram captured within this many seconds")
+    args = parser.parse_args(argv)
+
+    for flow in flows(read_records(args.path), dedupe_window=args.dedupe_window):
+        if args.command == 'timeline':
+            _print_timeline(flow)
+        else:
+            _print_summary(flow, args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+# lets tests import the top-level modules (datagram, transport, ...) when run with plain `pytest`
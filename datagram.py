@@ -11,6 +11,7 @@ class TCPFlag(IntFlag):
     ACK = 1 << 1
     FIN = 1 << 2
     RST = 1 << 3
+    FOP = 1 << 4  # fast open: cookie request/cookie (+ early data) carried on SYN and SYN-ACK
 
 
 @dataclass(frozen=True)
@@ -20,35 +21,38 @@ class Datagram:
     seq_number: int
     ack_number: int
     flags: TCPFlag
-    data: bytes
+    data: bytes | memoryview
 
     HEADER_FORMAT = 'HHIIB'
     HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
 
     def pack(self) -> bytes:
-        header = struct.pack(
+        return self.pack_header() + self.data
+
+    def pack_header(self) -> bytes:
+        return struct.pack(
             self.HEADER_FORMAT,
-        self.source_port,
+            self.source_port,
             self.destination_port,
             self.seq_number,
             self.ack_number,
             self.flags
         )
-        return header + self.data
 
     @classmethod
     def unpack(cls, payload: bytes) -> Datagram:
-        header_bytes = payload[:cls.HEADER_SIZE]
-        data_bytes = payload[cls.HEADER_SIZE:]
+        return cls.unpack_header(payload[:cls.HEADER_SIZE], data=payload[cls.HEADER_SIZE:])
 
-        headers = struct.unpack(cls.HEADER_FORMAT, header_bytes)
+    @classmethod
+    def unpack_header(cls, header: bytes | bytearray, data: bytes | memoryview = b'') -> Datagram:
+        headers = struct.unpack(cls.HEADER_FORMAT, header)
         return cls(
             source_port=headers[0],
             destination_port=headers[1],
             seq_number=headers[2],
             ack_number=headers[3],
             flags=TCPFlag(headers[4]),
-            data=data_bytes
+            data=data
         )
 
     def has_exact_flags(self, flags: TCPFlag) -> bool:
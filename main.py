@@ -1,9 +1,9 @@
-import threading
-import time
+import argparse
 
 from tcp_connection.client import Connector
 from tcp_connection.server import ConnectionListener
 from tcp_connection_v2 import Address
+from transport import SimulatedNetwork, Transport, udp_transport
 
 SERVER_HOST = 'localhost'
 SERVER_PORT = 80
@@ -14,20 +14,28 @@ CLIENT_PORT = 400
 CLIENT_ADDR = Address(host=CLIENT_HOST, port=CLIENT_PORT)
 
 
-def run_server():
-    s = ConnectionListener(SERVER_ADDR).listen()
+def run_server(transport: Transport):
+    s = ConnectionListener(SERVER_ADDR, transport=transport).listen()
     conn = s.accept()
 
 
-def run_client():
-    s = Connector(CLIENT_ADDR)
+def run_client(transport: Transport):
+    transport.sleep(0.2)  # give the server time to start listening
+    s = Connector(CLIENT_ADDR, transport=transport)
     conn = s.connect(SERVER_ADDR)
 
 
 if __name__ == "__main__":
-    server_task = threading.Thread(target=run_server)
-    client_task = threading.Thread(target=run_client, name="Client")
-
-    server_task.start()
-    time.sleep(0.2)
-    client_task.start()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--simulated', action='store_true', help="run on an in-process network with a virtual clock")
+    args = parser.parse_args()
+
+    if args.simulated:
+        network = SimulatedNetwork()
+        # spawns both before either runs, so the virtual clock can't move until the client exists
+        network.run(lambda: run_server(network), lambda: run_client(network))
+    else:
+        server_task = udp_transport.spawn(target=lambda: run_server(udp_transport), name="Server")
+        client_task = udp_transport.spawn(target=lambda: run_client(udp_transport), name="Client")
+        server_task.join()
+        client_task.join()
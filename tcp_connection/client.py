@@ -1,54 +1,102 @@
 from __future__ import annotations
 
 import struct
-from random import randbytes
 
 from datagram import Datagram, TCPFlag
-from tcp_connection.utils import seq_increment, Address
+from tcp_connection.metrics import CONNECTOR, DEFAULT_MSS, PathMetrics, PathMetricsCache
+from tcp_connection.utils import seq_increment, Address, FAST_OPEN_COOKIE_SIZE, HANDSHAKE_TIMEOUT
+from transport import Transport, udp_transport
 import socket
 
 
 class Connector:
     _peer_addr: Address
 
-    def __init__(self, addr: Address):
+    def __init__(
+            self,
+            addr: Address,
+            fast_open: bool = False,
+            metrics_cache: PathMetricsCache | None = None,
+            transport: Transport = udp_transport
+    ):
         self._addr = addr
+        self._transport = transport
+        self._fast_open = fast_open
+        self._metrics_cache = metrics_cache if metrics_cache is not None else transport.path_metrics
+        self._cookies: dict[tuple[str, int], bytes] = {}  # fast open cookies issued by each listener
 
-    def connect(self, peer_addr: Address) -> TCPConnection:
+    def connect(self, peer_addr: Address, data: bytes = b'') -> TCPConnection:
+        """
+        With fast open enabled and a cookie from an earlier connection to the same listener,
+        `data` travels on the SYN and the server's answer comes back on the SYN-ACK.
+        Without a cookie, if the server rejects it, or if cookie and `data` don't fit in one segment,
+        `data` is returned in the connection's `unsent_data` for the caller to send.
+        """
         print(f"Client: Attempting to establish connection...")
         self._peer_addr = peer_addr
-        conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        conn = self._transport.socket()
         conn.bind((self._addr.host, self._addr.port))
 
-        seq_number = int(struct.unpack('I', randbytes(4))[0])  # 32bit int
+        flags = TCPFlag.SYN
+        syn_data = b''
+        if self._fast_open:
+            flags |= TCPFlag.FOP
+            cookie = self._cookies.get((peer_addr.host, peer_addr.port))
+            if cookie is not None and data and len(cookie) + len(data) <= DEFAULT_MSS:
+                syn_data = cookie + data
+
+        # start from what the last connection to this listener learned about the path
+        metrics = self._metrics_cache.lookup(CONNECTOR, peer_addr)
+
+        seq_number = int(struct.unpack('I', self._transport.randbytes(4))[0])  # 32bit int
         print(f"Client: SEQ number: {seq_number}")
         dgram = Datagram(
             source_port=self._addr.port,
             destination_port=self._peer_addr.port,
             seq_number=seq_number,
             ack_number=0,
-            flags=TCPFlag.SYN,
-            data=b''
+            flags=flags,
+            data=syn_data
         )
         conn.sendto(dgram.pack(), (self._peer_addr.host, self._peer_addr.port))
+        syn_sent_at = self._transport.time()
+        syn_seq_number = seq_number
         seq_number += seq_increment(dgram.flags, dgram.data)
 
         print(f"Client: Waiting for SYN-ACK...")
-        conn.settimeout(1.0)
+        # nothing retransmits the handshake, so the cached RTO can only extend the wait, never cut it short
+        conn.settimeout(max(HANDSHAKE_TIMEOUT, metrics.rto))
         try:
             payload = conn.recv(1024)
         except socket.timeout:
             raise Exception(f"Client timed out waiting for SYN-ACK from the peer")
         conn.settimeout(None)
+        syn_ack_rtt = self._transport.time() - syn_sent_at
 
         dgram = Datagram.unpack(payload)
         print(f"Client: Received {dgram=}")
-        if not dgram.has_exact_flags(TCPFlag.SYN | TCPFlag.ACK):
+        if not (dgram.has_exact_flags(TCPFlag.SYN | TCPFlag.ACK)
+                or self._fast_open and dgram.has_exact_flags(TCPFlag.SYN | TCPFlag.ACK | TCPFlag.FOP)):
             raise Exception(f"Expected a SYN-ACK response from the peer, got {dgram.flags.name}")
 
+        syn_data_accepted = bool(syn_data) and dgram.ack_number == seq_number
+        if syn_data and not syn_data_accepted:
+            # the server only ACKed the SYN itself, early data has been dropped
+            seq_number = syn_seq_number + seq_increment(flags, b'')
+
         if dgram.ack_number != seq_number:
             raise Exception(f"UnACKed response from the peer - expected {seq_number}, got {dgram.ack_number}")
 
+        if not syn_data_accepted:
+            # a SYN-ACK answering early data waited for the server app, its delay isn't the path's
+            metrics.add_rtt_sample(syn_ack_rtt)
+
+        early_data = b''
+        if dgram.flags & TCPFlag.FOP:
+            self._cookies[(peer_addr.host, peer_addr.port)] = dgram.data[:FAST_OPEN_COOKIE_SIZE]
+            if syn_data_accepted:
+                early_data = dgram.data[FAST_OPEN_COOKIE_SIZE:]
+
         # switch from the welcome socket to the one the server established persistent connection on
         self._peer_addr = Address(self._peer_addr.host, dgram.source_port)
         dgram = Datagram(
@@ -61,11 +109,27 @@ class Connector:
         )
         conn.sendto(dgram.pack(), (self._peer_addr.host, self._peer_addr.port))
         seq_number += seq_increment(dgram.flags, dgram.data)
+        self._metrics_cache.store(CONNECTOR, peer_addr, metrics)
 
-        return TCPConnection()
+        return TCPConnection(
+            metrics=metrics,
+            early_data=early_data,
+            syn_data_accepted=syn_data_accepted,
+            unsent_data=b'' if syn_data_accepted else data
+        )
 
 
 class TCPConnection:
 
-    def __init__(self):
+    def __init__(
+            self,
+            metrics: PathMetrics,
+            early_data: bytes = b'',
+            syn_data_accepted: bool = False,
+            unsent_data: bytes = b''
+    ):
         print("Client: Connection established")
+        self.metrics = metrics
+        self.early_data = early_data  # server's answer carried on the SYN-ACK
+        self.syn_data_accepted = syn_data_accepted
+        self.unsent_data = unsent_data  # data passed to connect() that the SYN couldn't deliver
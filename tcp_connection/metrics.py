@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import dataclass, replace
+
+from datagram import Datagram
+from tcp_connection.utils import Address
+
+DEFAULT_MSS = 1024 - Datagram.HEADER_SIZE  # peers read whole datagrams into 1024 byte buffers
+INITIAL_CWND = 10  # segments
+INITIAL_RTO = 1.0  # seconds, RFC 6298
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+
+# the side of the handshake an entry was measured from, a process connecting to and accepting from
+# the same host keeps both apart
+CONNECTOR = 'connector'
+LISTENER = 'listener'
+
+_RTT_ALPHA = 1 / 8
+_RTT_BETA = 1 / 4
+
+
+@dataclass
+class PathMetrics:
+    srtt: float | None = None
+    rttvar: float | None = None
+    cwnd: int = INITIAL_CWND  # segments
+    ssthresh: int | None = None  # None until the first loss - slow start is unbounded
+    mss: int = DEFAULT_MSS
+
+    @property
+    def rto(self) -> float:
+        if self.srtt is None:
+            return INITIAL_RTO
+
+        return min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def add_rtt_sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+            return
+
+        self.rttvar = (1 - _RTT_BETA) * self.rttvar + _RTT_BETA * abs(self.srtt - rtt)
+        self.srtt = (1 - _RTT_ALPHA) * self.srtt + _RTT_ALPHA * rtt
+
+
+class PathMetricsCache:
+    """
+    Bounded LRU of the last known path parameters per role and destination address, so a new
+    connection to a recently seen peer can start from them instead of the conservative defaults.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 600.0, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: OrderedDict[tuple[str, str, int], tuple[float, PathMetrics]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, role: str, addr: Address) -> PathMetrics | None:
+        key = (role, addr.host, addr.port)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        stored_at, metrics = entry
+        if self.clock() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return replace(metrics)  # connections never share an instance with the cache
+
+    def lookup(self, role: str, addr: Address) -> PathMetrics:
+        metrics = self.get(role, addr)
+        return metrics if metrics is not None else PathMetrics()
+
+    def store(self, role: str, addr: Address, metrics: PathMetrics) -> None:
+        key = (role, addr.host, addr.port)
+        self._entries[key] = (self.clock(), replace(metrics))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+path_metrics = PathMetricsCache()  # shared by every connector and listener unless told otherwise
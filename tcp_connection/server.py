@@ -1,10 +1,13 @@
 from __future__ import annotations
+import hashlib
+import hmac
 import socket
 import struct
-from random import randbytes
 
 from datagram import Datagram, TCPFlag
-from tcp_connection.utils import seq_increment, Address
+from tcp_connection.metrics import DEFAULT_MSS, LISTENER, PathMetrics, PathMetricsCache
+from tcp_connection.utils import seq_increment, Address, FAST_OPEN_COOKIE_SIZE, HANDSHAKE_TIMEOUT
+from transport import Transport, udp_transport
 
 
 class ConnectionListener:
@@ -12,12 +15,21 @@ class ConnectionListener:
     _wcm_socket: socket.socket
     _syn_dgram: Datagram
 
-    def __init__(self, addr: Address):
+    def __init__(
+            self,
+            addr: Address,
+            fast_open: bool = False,
+            metrics_cache: PathMetricsCache | None = None,
+            transport: Transport = udp_transport
+    ):
         self._addr = addr
+        self._transport = transport
+        self._fop_secret = transport.secret_bytes(16) if fast_open else None  # keys the cookie HMAC
+        self._metrics_cache = metrics_cache if metrics_cache is not None else transport.path_metrics
 
     def listen(self) -> _ConnectionRequestHandler:
         print(f"Server: Listening for connections...")
-        self._wcm_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._wcm_socket = self._transport.socket()
         self._wcm_socket.bind((self._addr.host, self._addr.port))
 
         self._wcm_socket.settimeout(1.0)  # to allow keyboard interrupts
@@ -29,7 +41,7 @@ class ConnectionListener:
                     dgram = Datagram.unpack(payload)
                     print(f"Server: {dgram=}")
 
-                    if dgram.has_exact_flags(TCPFlag.SYN):
+                    if dgram.has_exact_flags(TCPFlag.SYN) or dgram.has_exact_flags(TCPFlag.SYN | TCPFlag.FOP):
                         self._peer_addr = Address(addr[0], addr[1])
                         self._syn_dgram = dgram
                         # TODO: in the future, it will have to keep listening for other SYN requests
@@ -48,7 +60,10 @@ class ConnectionListener:
             addr=self._addr,
             peer_addr=self._peer_addr,
             wcm_socket=self._wcm_socket,
-            syn_dgram=self._syn_dgram
+            syn_dgram=self._syn_dgram,
+            metrics_cache=self._metrics_cache,
+            transport=self._transport,
+            fop_secret=self._fop_secret
         )
 
 
@@ -58,39 +73,78 @@ class _ConnectionRequestHandler:
     _ack_number: int = 0
 
     # TODO: introduce a protocol that prevents closing the welcome socket
-    def __init__(self, addr: Address, peer_addr: Address, wcm_socket: socket.socket, syn_dgram: Datagram):
+    def __init__(
+            self,
+            addr: Address,
+            peer_addr: Address,
+            wcm_socket: socket.socket,
+            syn_dgram: Datagram,
+            metrics_cache: PathMetricsCache,
+            transport: Transport,
+            fop_secret: bytes | None = None
+    ):
         self._addr = addr
         self._peer_addr = peer_addr
         self._wcm_socket = wcm_socket
         self._syn_dgram = syn_dgram
+        self._metrics_cache = metrics_cache
+        self._transport = transport
+        self._syn_ack_sent_at: float | None = None
+
+        # fast open is only answered if both sides opted in
+        self._fop_cookie = None
+        if fop_secret is not None and syn_dgram.flags & TCPFlag.FOP:
+            self._fop_cookie = _fast_open_cookie(fop_secret, peer_addr.host)
+
+        self.early_data = b''  # request data carried on the SYN, only set for a valid cookie
+        if self._fop_cookie is not None and len(syn_dgram.data) > FAST_OPEN_COOKIE_SIZE:
+            if hmac.compare_digest(syn_dgram.data[:FAST_OPEN_COOKIE_SIZE], self._fop_cookie):
+                self.early_data = syn_dgram.data[FAST_OPEN_COOKIE_SIZE:]
 
-    def accept(self) -> _ServerSideConnection:
         # assign a new socket for persistent connection
-        self._conn = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._conn = self._transport.socket()
         self._conn.bind((self._addr.host, 0))  # random available socket
         _, conn_port = self._conn.getsockname()
         self._addr = Address(self._addr.host, conn_port)
 
-        self._seq_number = int(struct.unpack('I', randbytes(4))[0])  # 32bit int
+        self._seq_number = int(struct.unpack('I', self._transport.randbytes(4))[0])  # 32bit int
         print(f"Server: SEQ number: {self._seq_number}")
-        dgram = Datagram(
-            source_port=conn_port,
-            destination_port=self._peer_addr.port,
-            seq_number=self._seq_number,
-            ack_number=self._syn_dgram.seq_number + seq_increment(self._syn_dgram.flags, self._syn_dgram.data),
-            flags=TCPFlag.SYN | TCPFlag.ACK,
-            data=b''
-        )
-        self._wcm_socket.sendto(dgram.pack(), (self._peer_addr.host, self._peer_addr.port))
-        self._seq_number += seq_increment(dgram.flags, dgram.data)
+
+        # answer the SYN right away like a kernel would, so however long the app takes to accept()
+        # the peer's handshake RTT stays a network round trip. Only an answer to early data has to wait.
+        if not self.early_data:
+            self._send_syn_ack(b'')
+
+    def accept(self, data: bytes = b'') -> _ServerSideConnection:
+        """
+        `data` answers the request found in `early_data` and is sent on the SYN-ACK.
+        If the SYN carried no accepted early data, or cookie and `data` don't fit in one segment,
+        it's returned in the connection's `unsent_data` for the caller to send.
+        """
+        unsent_data = data
+        if self._syn_ack_sent_at is None:
+            fits = len(self._fop_cookie) + len(data) <= DEFAULT_MSS
+            self._send_syn_ack(data if fits else b'')
+            if fits:
+                unsent_data = b''
 
         # wait for ACK
-        self._conn.settimeout(1.0)
+        metrics = self._metrics_cache.lookup(LISTENER, self._peer_addr)
+        self._conn.settimeout(0)
         try:
             payload = self._conn.recv(1024)
-        except socket.timeout:
-            raise Exception(f"Timeout waiting for SYN-ACK from the peer")
+            rtt = None  # it's been waiting for the app to accept(), when it arrived is unknown
+        except BlockingIOError:
+            # nothing retransmits the handshake, so the cached RTO can only extend the wait, never cut it short
+            self._conn.settimeout(max(HANDSHAKE_TIMEOUT, metrics.rto))
+            try:
+                payload = self._conn.recv(1024)
+            except socket.timeout:
+                raise Exception(f"Timeout waiting for SYN-ACK from the peer")
+            rtt = self._transport.time() - self._syn_ack_sent_at
         self._conn.settimeout(None)
+        if rtt is not None:
+            metrics.add_rtt_sample(rtt)
 
         dgram = Datagram.unpack(payload)
         if not dgram.has_exact_flags(TCPFlag.ACK):
@@ -99,16 +153,55 @@ class _ConnectionRequestHandler:
         if dgram.ack_number != self._seq_number:
             raise Exception(f"unACKed response from the peer - expected {self._seq_number}, got {dgram.ack_number}")
 
+        self._metrics_cache.store(LISTENER, self._peer_addr, metrics)
         return _ServerSideConnection(
             addr=self._addr,
             peer_addr=self._peer_addr,
             seq_number=self._seq_number,
             ack_number=self._ack_number,
-            conn=self._conn
+            conn=self._conn,
+            metrics=metrics,
+            unsent_data=unsent_data
         )
 
+    def _send_syn_ack(self, answer: bytes) -> None:
+        # ACK the SYN's data only if it was accepted, so the peer knows whether to resend it
+        acked_data = self._syn_dgram.data if self.early_data else b''
+        flags = TCPFlag.SYN | TCPFlag.ACK
+        resp_data = b''
+        if self._fop_cookie is not None:
+            flags |= TCPFlag.FOP
+            resp_data = self._fop_cookie + answer
+
+        dgram = Datagram(
+            source_port=self._addr.port,
+            destination_port=self._peer_addr.port,
+            seq_number=self._seq_number,
+            ack_number=self._syn_dgram.seq_number + seq_increment(self._syn_dgram.flags, acked_data),
+            flags=flags,
+            data=resp_data
+        )
+        self._wcm_socket.sendto(dgram.pack(), (self._peer_addr.host, self._peer_addr.port))
+        self._syn_ack_sent_at = self._transport.time()
+        self._seq_number += seq_increment(dgram.flags, dgram.data)
+
 
 class _ServerSideConnection:
 
-    def __init__(self, addr: Address, peer_addr: Address, seq_number: int, ack_number: int, conn: socket.socket):
+    def __init__(
+            self,
+            addr: Address,
+            peer_addr: Address,
+            seq_number: int,
+            ack_number: int,
+            conn: socket.socket,
+            metrics: PathMetrics,
+            unsent_data: bytes = b''
+    ):
         print("Server: Connection established")
+        self.metrics = metrics
+        self.unsent_data = unsent_data  # data passed to accept() that the SYN-ACK couldn't deliver
+
+
+def _fast_open_cookie(secret: bytes, host: str) -> bytes:
+    return hmac.new(secret, host.encode(), hashlib.sha256).digest()[:FAST_OPEN_COOKIE_SIZE]
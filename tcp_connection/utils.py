@@ -2,6 +2,9 @@ from dataclasses import dataclass
 
 from datagram import TCPFlag
 
+FAST_OPEN_COOKIE_SIZE = 8
+HANDSHAKE_TIMEOUT = 1.0  # seconds to wait for the peer's handshake reply before giving up
+
 
 @dataclass
 class Address:
@@ -4,12 +4,13 @@ import abc
 import socket
 import struct
 import threading
+from collections import deque
 from collections.abc import Callable
 from enum import Enum
-from random import randbytes
 
 from datagram import Datagram, TCPFlag
 from tcp_connection.utils import Address
+from transport import Transport, udp_transport
 
 
 class TCPStateName(Enum):
@@ -20,23 +21,20 @@ class TCPStateName(Enum):
     ESTABLISHED = 4
 
 
-class StateFactory:
+class TCPEvent(Enum):
+    ACTIVE_OPEN = 0
+    SYN = 1
+    SYN_ACK = 2
+    ACK = 3
+    OPENED = 4  # posted by the handshake states once their side is done
 
-    def __init__(self):
-        self.mapping: dict[TCPStateName, Callable[[], State]] = {
-            TCPStateName.CLOSED: ClosedState,
-            TCPStateName.LISTEN: ListenState,
-            TCPStateName.SYN_SENT: SynSentState,
-            TCPStateName.SYN_RECEIVED: SynReceivedState,
-            TCPStateName.ESTABLISHED: EstablishedState
-        }
 
-    def create(self, name: TCPStateName):
-        init = self.mapping.get(name)
-        if init is None:
-            raise Exception(f"No class configured for {name=}")
-
-        return init()
+# segment flags -> event fed to the state machine
+_SEGMENT_EVENTS: dict[TCPFlag, TCPEvent] = {
+    TCPFlag.SYN: TCPEvent.SYN,
+    TCPFlag.SYN | TCPFlag.ACK: TCPEvent.SYN_ACK,
+    TCPFlag.ACK: TCPEvent.ACK,
+}
 
 
 class ConnectionContext:
@@ -45,24 +43,29 @@ class ConnectionContext:
     wcm_socket: socket.socket
     addr: Address
     rmt_addr: Address
+    seg_addr: Address  # source of the last received segment
     seq_number: int = 0
     ack_number: int = 0
+    transport: Transport
     host_name: str  # just logging
 
     syn_dgram: Datagram  # part of the listener (used in listen and SYN-ACK)
 
-    _state: State
     _state_name: TCPStateName
-    _state_factory: StateFactory
+    _events: deque[tuple[TCPEvent, Datagram | None]]
 
-    def __init__(self, addr: Address):
+    def __init__(self, addr: Address, transport: Transport = udp_transport):
         self.addr = addr
+        self.transport = transport
 
-        self._state_factory = StateFactory()
-        self._state = None
         self._state_name = None
+        self._events = deque()
         self.host_name = threading.current_thread().name
 
+    @property
+    def state_name(self) -> TCPStateName:
+        return self._state_name
+
     def set_state(self, new_state_name: TCPStateName):
         # for debugging
         if self._state_name is None:
@@ -70,178 +73,212 @@ class ConnectionContext:
         else:
             print(f"[{self.host_name}]: Changing state from {self._state_name.name} to {new_state_name.name}")
 
-        self._state = self._state_factory.create(name=new_state_name)
-        self._state.set_context(self)
         self._state_name = new_state_name
 
+    def post(self, event: TCPEvent, dgram: Datagram | None = None):
+        self._events.append((event, dgram))
+
     def connect(self, rmt_addr: Address):
         print(f"[{self.host_name}]: Attempting to establish connection...")
         self.rmt_addr = rmt_addr
-        self.conn_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.conn_socket = self.transport.socket()
         self.conn_socket.bind((self.addr.host, self.addr.port))
         self.set_state(new_state_name=TCPStateName.CLOSED)
-        self.handle()
+        self.post(TCPEvent.ACTIVE_OPEN)
+        self.run()
 
     def listen(self):
         print(f"[{self.host_name}]: Listening for connections...")
-        self.wcm_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.wcm_socket = self.transport.socket()
         self.wcm_socket.bind((self.addr.host, self.addr.port))
         self.set_state(new_state_name=TCPStateName.LISTEN)
-        self.handle()
+        try:
+            self.run()
+        except KeyboardInterrupt:
+            print(f"[{self.host_name}]: Shutting down gracefully")
+            self.wcm_socket.close()
+
+    def run(self):
+        """Drains the event queue, reading segments whenever the current state waits for one."""
+        while True:
+            if not self._events:
+                receive = _SEGMENT_SOURCES.get(self._state_name)
+                if receive is None:
+                    return  # nothing left to wait for
+                self._receive_segment(receive)
+                continue
+
+            event, dgram = self._events.popleft()
+            handler = _TRANSITIONS.get((self._state_name, event))
+            if handler is None:
+                if self._state_name is TCPStateName.LISTEN:
+                    print(f"[{self.host_name}]: Ignoring non-SYN msg")
+                    continue
+                raise Exception(f"[{self.host_name}]: Unexpected {event.name} in state {self._state_name.name}")
 
-    def handle(self):
-        self._state.handle()
+            handler.handle(self, dgram)
 
+    def _receive_segment(self, receive: Callable[[ConnectionContext], tuple[bytes, tuple[str, int]]]):
+        payload, addr = receive(self)
+        self.seg_addr = Address(addr[0], addr[1])
+        dgram = Datagram.unpack(payload)
+        print(f"[{self.host_name}]: {dgram=}")
 
-class State(abc.ABC):
-    _ctx: ConnectionContext
+        event = _SEGMENT_EVENTS.get(dgram.flags)
+        if event is not None:
+            self.post(event, dgram)
+        elif self._state_name is TCPStateName.LISTEN:
+            print(f"[{self.host_name}]: Ignoring non-SYN msg")
+        else:
+            raise Exception(f"[{self.host_name}]: Unsupported flags {dgram.flags!r} received")
+
+
+def _recv_welcome(ctx: ConnectionContext) -> tuple[bytes, tuple[str, int]]:
+    ctx.wcm_socket.settimeout(1.0)  # otherwise it will block and swallow keyboard interrupts
+    while True:
+        try:
+            payload, addr = ctx.wcm_socket.recvfrom(1024)
+        except socket.timeout:
+            continue
+
+        print(f"[{ctx.host_name}]: Got message from {addr}")
+        return payload, addr
 
-    def set_context(self, ctx: ConnectionContext):
-        self._ctx = ctx
 
-    def handle(self) -> None:
+def _recv_connection(ctx: ConnectionContext) -> tuple[bytes, tuple[str, int]]:
+    ctx.conn_socket.settimeout(1.0)
+    try:
+        payload, addr = ctx.conn_socket.recvfrom(1024)
+    except socket.timeout:
+        raise Exception(f"[{ctx.host_name}]: Timeout waiting for a response from the peer in {ctx.state_name.name}")
+    ctx.conn_socket.settimeout(None)
+    return payload, addr
+
+
+class State(abc.ABC):
+    """
+    Stateless transition handler. A single instance is shared by every connection,
+    all per-connection data lives on the context.
+    """
+
+    def handle(self, ctx: ConnectionContext, dgram: Datagram | None) -> None:
         raise NotImplementedError
 
 
 class ClosedState(State):
 
-    def handle(self) -> None:
+    def handle(self, ctx: ConnectionContext, dgram: Datagram | None) -> None:
         # TODO: might want to introduce another method/protocol for this
-        if self._ctx.closed:
-            self._ctx.seq_number = int(struct.unpack('I', randbytes(4))[0])  # 32bit int
-            print(f"[{self._ctx.host_name}]: SEQ number: {self._ctx.seq_number}")
+        if ctx.closed:
+            ctx.seq_number = int(struct.unpack('I', ctx.transport.randbytes(4))[0])  # 32bit int
+            print(f"[{ctx.host_name}]: SEQ number: {ctx.seq_number}")
             dgram = Datagram(
-                source_port=self._ctx.addr.port,
-                destination_port=self._ctx.rmt_addr.port,
-                seq_number=self._ctx.seq_number,
-                ack_number=self._ctx.ack_number,
+                source_port=ctx.addr.port,
+                destination_port=ctx.rmt_addr.port,
+                seq_number=ctx.seq_number,
+                ack_number=ctx.ack_number,
                 flags=TCPFlag.SYN,
                 data=b''
             )
-            self._ctx.conn_socket.sendto(dgram.pack(), (self._ctx.rmt_addr.host, self._ctx.rmt_addr.port))
-            self._ctx.seq_number += _seq_increment(dgram.flags, dgram.data)
-            self._ctx.set_state(TCPStateName.SYN_SENT)
-            self._ctx.handle()
+            ctx.conn_socket.sendto(dgram.pack(), (ctx.rmt_addr.host, ctx.rmt_addr.port))
+            ctx.seq_number += _seq_increment(dgram.flags, dgram.data)
+            ctx.set_state(TCPStateName.SYN_SENT)
+            print(f"[{ctx.host_name}]: awaiting SYN-ACK...")
 
         # TODO: otherwise, request closure
 
 
 class ListenState(State):
 
-    def handle(self) -> None:
+    def handle(self, ctx: ConnectionContext, dgram: Datagram | None) -> None:
         # TODO: introduce an interface with .listen()
-        # TODO: for capturing SYNs
         # TODO: return interface with .accept() that will use that SYN dgram
-        self._ctx.wcm_socket.settimeout(1.0)  # otherwise it will block and swallow keyboard interrupts
-        try:
-            while True:
-                try:
-                    payload, addr = self._ctx.wcm_socket.recvfrom(1024)
-                    print(f"[{self._ctx.host_name}]: Got message from {addr}")
-                    dgram = Datagram.unpack(payload)
-                    print(f"[{self._ctx.host_name}]: {dgram=}")
-
-                    if dgram.has_exact_flags(TCPFlag.SYN):
-                        self._ctx.rmt_addr = Address(addr[0], addr[1])
-                        self._ctx.syn_dgram = dgram
-                        # TODO: at some point, spawn another thread to keep listening for other SYN requests
-                        break
-
-                    print(f"[{self._ctx.host_name}]: Ignoring non-SYN msg")
-
-                except socket.timeout:
-                    continue
+        ctx.rmt_addr = ctx.seg_addr
+        ctx.syn_dgram = dgram
+        # TODO: at some point, spawn another thread to keep listening for other SYN requests
+        ctx.set_state(TCPStateName.SYN_RECEIVED)
 
-            self._ctx.set_state(TCPStateName.SYN_RECEIVED)
-            self._ctx.handle()
+        # assign a new socket for persistent connection
+        ctx.conn_socket = ctx.transport.socket()
+        ctx.conn_socket.bind((ctx.addr.host, 0))  # random available socket
+        _, conn_port = ctx.conn_socket.getsockname()
+        ctx.addr = Address(ctx.addr.host, conn_port)
 
-        except KeyboardInterrupt:
-            print(f"[{self._ctx.host_name}]: Shutting down gracefully")
-            self._ctx.wcm_socket.close()
+        ctx.seq_number = int(struct.unpack('I', ctx.transport.randbytes(4))[0])  # 32bit int
+        print(f"[{ctx.host_name}]: SEQ number: {ctx.seq_number}")
+        resp_dgram = Datagram(
+            source_port=conn_port,
+            destination_port=ctx.rmt_addr.port,
+            seq_number=ctx.seq_number,
+            ack_number=dgram.seq_number + _seq_increment(dgram.flags, dgram.data),
+            flags=TCPFlag.SYN | TCPFlag.ACK,
+            data=b''
+        )
+        ctx.wcm_socket.sendto(resp_dgram.pack(), (ctx.rmt_addr.host, ctx.rmt_addr.port))
+        ctx.seq_number += _seq_increment(resp_dgram.flags, resp_dgram.data)
 
 
 class SynSentState(State):
 
-    def handle(self) -> None:
-        print(f"[{self._ctx.host_name}]: awaiting SYN-ACK...")
-        self._ctx.conn_socket.settimeout(1.0)
-        try:
-            payload = self._ctx.conn_socket.recv(1024)
-        except socket.timeout:
-            raise Exception(f"[{self._ctx.host_name}]: Timeout waiting for SYN-ACK from the peer")
-        self._ctx.conn_socket.settimeout(None)
-
-        dgram = Datagram.unpack(payload)
-        print(f"[{self._ctx.host_name}]: {dgram=}")
-        if not dgram.has_exact_flags(TCPFlag.SYN | TCPFlag.ACK):
-            raise Exception(f"[{self._ctx.host_name}]: Expected a SYN-ACK response from the peer, got {dgram.flags.name}")
+    def handle(self, ctx: ConnectionContext, dgram: Datagram | None) -> None:
+        if dgram.ack_number != ctx.seq_number:
+            raise Exception(f"[{ctx.host_name}]: unACKed response from the peer - expected {ctx.seq_number}, got {dgram.ack_number}")
 
-        if dgram.ack_number != self._ctx.seq_number:
-            raise Exception(f"[{self._ctx.host_name}]: unACKed response from the peer - expected {self._ctx.seq_number}, got {dgram.ack_number}")
-
-        self._ctx.ack_number = dgram.seq_number
+        ctx.ack_number = dgram.seq_number
 
         # switch from the welcome socket to the one the server established persistent connection on
-        self._ctx.rmt_addr = Address(self._ctx.rmt_addr.host, dgram.source_port)
+        ctx.rmt_addr = Address(ctx.rmt_addr.host, dgram.source_port)
         resp_dgram = Datagram(
-            source_port=self._ctx.addr.port,
-            destination_port=self._ctx.rmt_addr.port,
-            seq_number=self._ctx.seq_number,
-            ack_number=self._ctx.ack_number + _seq_increment(dgram.flags, dgram.data),
+            source_port=ctx.addr.port,
+            destination_port=ctx.rmt_addr.port,
+            seq_number=ctx.seq_number,
+            ack_number=ctx.ack_number + _seq_increment(dgram.flags, dgram.data),
             flags=TCPFlag.ACK,
             data=b''
         )
-        self._ctx.conn_socket.sendto(resp_dgram.pack(), (self._ctx.rmt_addr.host, self._ctx.rmt_addr.port))
-        self._ctx.seq_number += _seq_increment(resp_dgram.flags, resp_dgram.data)
-        self._ctx.set_state(TCPStateName.ESTABLISHED)
-        self._ctx.handle()
+        ctx.conn_socket.sendto(resp_dgram.pack(), (ctx.rmt_addr.host, ctx.rmt_addr.port))
+        ctx.seq_number += _seq_increment(resp_dgram.flags, resp_dgram.data)
+        ctx.set_state(TCPStateName.ESTABLISHED)
+        ctx.post(TCPEvent.OPENED)
 
 
 class SynReceivedState(State):
 
-    def handle(self) -> None:
-        # assign a new socket for persistent connection
-        self._ctx.conn_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._ctx.conn_socket.bind((self._ctx.addr.host, 0))  # random available socket
-        _, conn_port = self._ctx.conn_socket.getsockname()
-        self._ctx.addr = Address(self._ctx.addr.host, conn_port)
-
-        self._ctx.seq_number = int(struct.unpack('I', randbytes(4))[0])  # 32bit int
-        print(f"[{self._ctx.host_name}]: SEQ number: {self._ctx.seq_number}")
-        dgram = Datagram(
-            source_port=conn_port,
-            destination_port=self._ctx.rmt_addr.port,
-            seq_number=self._ctx.seq_number,
-            ack_number=self._ctx.syn_dgram.seq_number + _seq_increment(self._ctx.syn_dgram.flags, self._ctx.syn_dgram.data),
-            flags=TCPFlag.SYN | TCPFlag.ACK,
-            data=b''
-        )
-        self._ctx.wcm_socket.sendto(dgram.pack(), (self._ctx.rmt_addr.host, self._ctx.rmt_addr.port))
-        self._ctx.seq_number += _seq_increment(dgram.flags, dgram.data)
-
-        # wait for ACK
-        self._ctx.conn_socket.settimeout(1.0)
-        try:
-            payload = self._ctx.conn_socket.recv(1024)
-        except socket.timeout:
-            raise Exception(f"[{self._ctx.host_name}]: Timeout waiting for SYN-ACK from the peer")
-        self._ctx.conn_socket.settimeout(None)
-
-        dgram = Datagram.unpack(payload)
-        if not dgram.has_exact_flags(TCPFlag.ACK):
-            raise Exception(f"[{self._ctx.host_name}]: Expected an ACK response from the peer, got {dgram.flags.name}")
-
-        if dgram.ack_number != self._ctx.seq_number:
-            raise Exception(f"[{self._ctx.host_name}]: unACKed response from the peer - expected {self._ctx.seq_number}, got {dgram.ack_number}")
+    def handle(self, ctx: ConnectionContext, dgram: Datagram | None) -> None:
+        if dgram.ack_number != ctx.seq_number:
+            raise Exception(f"[{ctx.host_name}]: unACKed response from the peer - expected {ctx.seq_number}, got {dgram.ack_number}")
 
-        self._ctx.set_state(TCPStateName.ESTABLISHED)
-        self._ctx.handle()
+        ctx.set_state(TCPStateName.ESTABLISHED)
+        ctx.post(TCPEvent.OPENED)
 
 
 class EstablishedState(State):
 
-    def handle(self) -> None:
-        print(f"[{self._ctx.host_name}]: Connection established :)")
+    def handle(self, ctx: ConnectionContext, dgram: Datagram | None) -> None:
+        print(f"[{ctx.host_name}]: Connection established :)")
+
+
+CLOSED = ClosedState()
+LISTEN = ListenState()
+SYN_SENT = SynSentState()
+SYN_RECEIVED = SynReceivedState()
+ESTABLISHED = EstablishedState()
+
+# (current state, event) -> shared handler, anything missing is an invalid transition
+_TRANSITIONS: dict[tuple[TCPStateName, TCPEvent], State] = {
+    (TCPStateName.CLOSED, TCPEvent.ACTIVE_OPEN): CLOSED,
+    (TCPStateName.LISTEN, TCPEvent.SYN): LISTEN,
+    (TCPStateName.SYN_SENT, TCPEvent.SYN_ACK): SYN_SENT,
+    (TCPStateName.SYN_RECEIVED, TCPEvent.ACK): SYN_RECEIVED,
+    (TCPStateName.ESTABLISHED, TCPEvent.OPENED): ESTABLISHED,
+}
+
+# states that wait for a segment once their event queue is drained, and where to read it from
+_SEGMENT_SOURCES: dict[TCPStateName, Callable[[ConnectionContext], tuple[bytes, tuple[str, int]]]] = {
+    TCPStateName.LISTEN: _recv_welcome,
+    TCPStateName.SYN_SENT: _recv_connection,
+    TCPStateName.SYN_RECEIVED: _recv_connection,
+}
 
 
 def _seq_increment(flags: TCPFlag, data: bytes) -> int:
@@ -0,0 +1,94 @@
+import capture
+from datagram import Datagram, TCPFlag
+from tcp_connection.client import Connector
+from tcp_connection.server import ConnectionListener
+from tcp_connection.utils import Address
+from transport import SimulatedNetwork
+
+
+def test_simulated_capture_uses_virtual_time_and_made_up_hosts(tmp_path):
+    network = SimulatedNetwork(latency=0.01)
+    path = str(tmp_path / "trace.pcapng")
+    capture.enable(path, clock=network.time)
+    try:
+        network.run(
+            lambda: ConnectionListener(Address('srv', 80), transport=network).listen().accept(),
+            lambda: (network.sleep(0.1), Connector(Address('cli', 400), transport=network).connect(Address('srv', 80)))
+        )
+    finally:
+        capture.disable()
+
+    [flow] = capture.flows(capture.read_records(path))
+    rtts = [rtt for _, rtt in capture.rtt_samples(flow)]
+    assert rtts and all(abs(rtt - 0.02) < 1e-6 for rtt in rtts)  # a virtual round trip, not wall time
+
+
+def _record(timestamp, src, dst, flags, seq_number, ack_number=0, data=b'', direction=None):
+    datagram = Datagram(src[1], dst[1], seq_number, ack_number, flags, data)
+    return capture.Record(timestamp, src, dst, datagram, direction)
+
+
+def test_retransmitted_syn_stays_in_its_flow():
+    client, server = ('10.0.0.1', 400), ('10.0.0.2', 80)
+    records = [
+        _record(0.0, client, server, TCPFlag.SYN, 100),
+        _record(1.0, client, server, TCPFlag.SYN, 100),
+        _record(1.1, server, client, TCPFlag.SYN | TCPFlag.ACK, 500, 101),
+        _record(1.2, client, server, TCPFlag.ACK, 101, 501),
+    ]
+
+    [flow] = capture.flows(records)
+    assert flow.records == records
+    assert capture.retransmissions(flow) == [records[1]]
+
+
+def test_fast_open_handshake_survives_a_pcap_round_trip(tmp_path):
+    client, server, accepted = ('10.0.0.1', 400), ('10.0.0.2', 80), ('10.0.0.2', 49152)
+    records = [
+        _record(0.5, client, server, TCPFlag.SYN | TCPFlag.FOP, 100, direction=capture.SENT),  # cookie request
+        _record(0.75, accepted, client, TCPFlag.SYN | TCPFlag.ACK | TCPFlag.FOP, 500, 101, data=b'8-cookie',
+                direction=capture.RECEIVED),
+        _record(1.0, client, accepted, TCPFlag.ACK, 101, 508, direction=capture.SENT),
+    ]
+
+    path = str(tmp_path / "trace.pcapng")
+    timestamps = iter(record.timestamp for record in records)
+    with capture.Recorder(path, clock=lambda: next(timestamps)) as recorder:
+        for record in records:
+            recorder.record(record.datagram.pack(), record.src, record.dst, record.direction)
+
+    read_back = list(capture.read_records(path))
+    assert read_back == records
+    [flow] = capture.flows(read_back)
+    assert flow.records == records
+
+
+def test_quick_resend_captured_by_the_sender_alone_is_a_retransmission():
+    client, server = ('10.0.0.1', 400), ('10.0.0.2', 80)
+    records = [
+        _record(0.0, client, server, TCPFlag.NONE, 100, 500, data=b'data', direction=capture.SENT),
+        _record(0.03, client, server, TCPFlag.NONE, 100, 500, data=b'data', direction=capture.SENT),
+        _record(0.04, server, client, TCPFlag.ACK, 500, 104, direction=capture.RECEIVED),
+    ]
+
+    [flow] = capture.flows(records)
+    assert flow.records == records
+    assert capture.retransmissions(flow) == [records[1]]
+    assert capture.rtt_samples(flow) == []  # Karn's algorithm, the ACK may be for either copy
+
+
+def test_copies_captured_by_both_peers_are_paired():
+    client, server = ('10.0.0.1', 400), ('10.0.0.2', 80)
+    records = [
+        _record(0.01, client, server, TCPFlag.NONE, 100, 500, data=b'data', direction=capture.RECEIVED),  # recorded first
+        _record(0.012, client, server, TCPFlag.NONE, 100, 500, data=b'data', direction=capture.SENT),
+        _record(0.02, server, client, TCPFlag.ACK, 500, 104, direction=capture.SENT),
+        _record(0.03, server, client, TCPFlag.ACK, 500, 104, direction=capture.RECEIVED),
+    ]
+
+    [flow] = capture.flows(records)
+    assert [(record.direction, record.timestamp, record.received_at) for record in flow.records] == [
+        (capture.SENT, 0.012, 0.01),
+        (capture.SENT, 0.02, 0.03),
+    ]
+    assert capture.retransmissions(flow) == []
@@ -0,0 +1,69 @@
+from tcp_connection.client import Connector
+from tcp_connection.server import ConnectionListener
+from tcp_connection.utils import Address
+from transport import SimulatedNetwork
+
+SERVER_ADDR = Address('srv', 80)
+CLIENT_ADDR = Address('cli', 400)
+
+
+def _serve(listener, answer, requests, accepted):
+    handler = listener.listen()  # dropped on return, which frees the welcome port for the next listen()
+    requests.append(handler.early_data)
+    accepted.append(handler.accept(answer))
+
+
+def test_data_the_handshake_cannot_carry_is_handed_back():
+    network = SimulatedNetwork()
+    requests = []
+    accepted = []
+    connected = []
+
+    def server():
+        listener = ConnectionListener(SERVER_ADDR, fast_open=True, transport=network)
+        _serve(listener, b'answer', requests, accepted)
+        _serve(listener, b'answer', requests, accepted)
+        # a restarted listener has a new secret, so the client's cookie is rejected
+        listener = ConnectionListener(SERVER_ADDR, fast_open=True, transport=network)
+        _serve(listener, b'answer', requests, accepted)
+
+    def client():
+        connector = Connector(CLIENT_ADDR, fast_open=True, transport=network)
+        for _ in range(3):
+            network.sleep(0.1)
+            connected.append(connector.connect(SERVER_ADDR, b'request'))
+
+    network.run(server, client)
+
+    cold, warm, rejected = connected
+    assert [conn.unsent_data for conn in connected] == [b'request', b'', b'request']
+    assert [conn.early_data for conn in connected] == [b'', b'answer', b'']
+    assert not cold.syn_data_accepted and warm.syn_data_accepted and not rejected.syn_data_accepted
+    assert requests == [b'', b'request', b'']
+    assert [conn.unsent_data for conn in accepted] == [b'answer', b'', b'answer']
+
+
+def test_data_too_big_for_one_segment_stays_off_the_handshake():
+    network = SimulatedNetwork()
+    request, answer = b'r' * 2000, b'a' * 2000
+    requests = []
+    accepted = []
+    connected = []
+
+    def server():
+        listener = ConnectionListener(SERVER_ADDR, fast_open=True, transport=network)
+        for _ in range(2):
+            _serve(listener, answer, requests, accepted)
+
+    def client():
+        connector = Connector(CLIENT_ADDR, fast_open=True, transport=network)
+        for data in (b'request', request):  # the first one only fetches a cookie
+            network.sleep(0.1)
+            connected.append(connector.connect(SERVER_ADDR, data))
+
+    network.run(server, client)
+
+    assert requests == [b'', b'']
+    assert not connected[1].syn_data_accepted
+    assert connected[1].unsent_data == request
+    assert accepted[1].unsent_data == answer
@@ -0,0 +1,111 @@
+from tcp_connection.client import Connector
+from tcp_connection.metrics import CONNECTOR, LISTENER, PathMetrics, PathMetricsCache
+from tcp_connection.server import ConnectionListener
+from tcp_connection.utils import Address
+from transport import SimulatedNetwork
+
+SERVER_ADDR = Address('srv', 80)
+CLIENT_ADDR = Address('cli', 400)
+
+
+def test_reconnect_to_a_fast_peer_tolerates_a_slow_accept():
+    network = SimulatedNetwork()
+    connected = []
+
+    def server():
+        listener = ConnectionListener(SERVER_ADDR, transport=network)
+        listener.listen().accept()
+        handler = listener.listen()
+        network.sleep(0.3)  # well above the 1ms RTT the first handshake measured
+        handler.accept()
+
+    def client():
+        network.sleep(0.1)
+        for _ in range(2):
+            connected.append(Connector(CLIENT_ADDR, transport=network).connect(SERVER_ADDR))
+            network.sleep(0.1)  # let the server get back to listening
+
+    network.run(server, client)
+
+    assert len(connected) == 2
+    assert connected[0].metrics.rto < 0.3
+
+
+def test_a_slow_accept_is_not_taken_for_path_rtt():
+    network = SimulatedNetwork(latency=0.01)
+
+    def server():
+        handler = ConnectionListener(SERVER_ADDR, transport=network).listen()
+        network.sleep(0.3)
+        handler.accept()
+
+    def client():
+        network.sleep(0.1)
+        Connector(CLIENT_ADDR, transport=network).connect(SERVER_ADDR)
+
+    network.run(server, client)
+
+    assert abs(network.path_metrics.get(CONNECTOR, SERVER_ADDR).srtt - 0.02) < 1e-9
+    # the ACK was already waiting when the server got to accept() it, there's nothing to time
+    assert network.path_metrics.get(LISTENER, CLIENT_ADDR).srtt is None
+
+
+def test_listener_times_an_ack_it_waits_for():
+    network = SimulatedNetwork(latency=0.01)
+
+    def server():
+        ConnectionListener(SERVER_ADDR, transport=network).listen().accept()
+
+    def client():
+        network.sleep(0.1)
+        Connector(CLIENT_ADDR, transport=network).connect(SERVER_ADDR)
+
+    network.run(server, client)
+
+    assert abs(network.path_metrics.get(LISTENER, CLIENT_ADDR).srtt - 0.02) < 1e-9
+
+
+def test_connector_and_listener_entries_are_kept_apart():
+    cache = PathMetricsCache()
+    cache.store(CONNECTOR, SERVER_ADDR, PathMetrics(srtt=0.1, rttvar=0.05))
+    cache.store(LISTENER, SERVER_ADDR, PathMetrics(srtt=0.2, rttvar=0.1))
+
+    assert cache.get(CONNECTOR, SERVER_ADDR).srtt == 0.1
+    assert cache.get(LISTENER, SERVER_ADDR).srtt == 0.2
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = PathMetricsCache(max_entries=2)
+    first, second, third = Address('a', 1), Address('b', 1), Address('c', 1)
+    cache.store(CONNECTOR, first, PathMetrics())
+    cache.store(CONNECTOR, second, PathMetrics())
+    cache.get(CONNECTOR, first)  # now the most recently used
+    cache.store(CONNECTOR, third, PathMetrics())
+
+    assert len(cache) == 2
+    assert cache.get(CONNECTOR, second) is None
+    assert cache.get(CONNECTOR, first) is not None
+    assert cache.get(CONNECTOR, third) is not None
+
+
+def test_entries_expire_after_ttl():
+    now = [0.0]
+    cache = PathMetricsCache(ttl=10.0, clock=lambda: now[0])
+    cache.store(CONNECTOR, SERVER_ADDR, PathMetrics(srtt=0.1, rttvar=0.05))
+
+    now[0] = 10.0
+    assert cache.get(CONNECTOR, SERVER_ADDR) is not None
+    now[0] = 10.5
+    assert cache.get(CONNECTOR, SERVER_ADDR) is None
+    assert len(cache) == 0
+    assert cache.lookup(CONNECTOR, SERVER_ADDR) == PathMetrics()
+
+
+def test_cached_entries_are_copies():
+    cache = PathMetricsCache()
+    metrics = PathMetrics(srtt=0.1, rttvar=0.05)
+    cache.store(CONNECTOR, SERVER_ADDR, metrics)
+    metrics.add_rtt_sample(1.0)
+    cache.get(CONNECTOR, SERVER_ADDR).add_rtt_sample(1.0)
+
+    assert cache.get(CONNECTOR, SERVER_ADDR).srtt == 0.1
@@ -0,0 +1,132 @@
+import mmap
+import os
+
+import pytest
+
+from _tcp_connection import TCPConnection, TCPConnector, TCPListener
+from transport import SimulatedNetwork
+
+
+def _run(network, on_server, on_client):
+    """Runs both sides of one connection on `network`."""
+
+    def server():
+        listener = TCPListener('srv', 80, transport=network)
+        listener.listen()
+        on_server(listener.accept())
+
+    def client():
+        network.sleep(0.1)
+        on_client(TCPConnector('cli', 400, transport=network).connect(('srv', 80)))
+
+    network.run(server, client)
+
+
+def test_vectored_message_spanning_several_segments():
+    network = SimulatedNetwork()
+    header = b'LEN:3000\n'
+    body = bytes(range(256)) * 12
+    sent = []
+    received = bytearray()
+
+    def on_server(conn):
+        buffer = bytearray(TCPConnection.MSS)
+        while len(received) < len(header) + len(body):
+            size = conn.recv_into(buffer)
+            received.extend(buffer[:size])
+
+    _run(network, on_server, lambda conn: sent.append(conn.send_vectored([header, bytearray(body)])))
+
+    assert sent == [len(header) + len(body)]
+    assert bytes(received) == header + body
+
+
+def test_too_small_receive_buffer_loses_nothing():
+    network = SimulatedNetwork()
+    errors = []
+    received = []
+
+    def on_server(conn):
+        try:
+            conn.recv_into(bytearray(10))
+        except ValueError as e:
+            errors.append(e)
+        buffer = bytearray(TCPConnection.MSS)
+        size = conn.recv_into(buffer)
+        received.append(bytes(buffer[:size]))
+
+    _run(network, on_server, lambda conn: conn.send_vectored([b'x' * 100]))
+
+    assert len(errors) == 1
+    assert received == [b'x' * 100]
+
+
+def test_file_ranges_at_unaligned_offsets(tmp_path):
+    network = SimulatedNetwork()
+    granularity = mmap.ALLOCATIONGRANULARITY
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    src.write_bytes(bytes(range(251)) * (3 * granularity // 251))
+    dst.write_bytes(b'.' * granularity * 2)
+    send_offset, recv_offset, count = granularity + 123, granularity + 77, 5000
+    counts = []
+
+    def on_server(conn):
+        counts.append(conn.recvfile(str(dst), count, offset=recv_offset))
+
+    _run(network, on_server, lambda conn: counts.append(conn.sendfile(str(src), offset=send_offset, count=count)))
+
+    assert counts == [count, count]
+    expected = bytearray(b'.' * granularity * 2)
+    expected[recv_offset:recv_offset + count] = src.read_bytes()[send_offset:send_offset + count]
+    assert dst.read_bytes() == expected  # grown to fit, the bytes around the range untouched
+
+
+def test_sendfile_from_an_offset_to_the_end(tmp_path):
+    network = SimulatedNetwork()
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    src.write_bytes(bytes(range(256)) * 20)
+    offset = 1000
+    sent = []
+
+    def on_server(conn):
+        conn.recvfile(str(dst), src.stat().st_size - offset)
+
+    _run(network, on_server, lambda conn: sent.append(conn.sendfile(str(src), offset=offset)))
+
+    assert sent == [src.stat().st_size - offset]
+    assert dst.read_bytes() == src.read_bytes()[offset:]
+
+
+def test_file_descriptors_are_left_open(tmp_path):
+    network = SimulatedNetwork()
+    src = tmp_path / "src.bin"
+    src.write_bytes(b'abc' * 1000)
+    src_fd = os.open(src, os.O_RDONLY)
+    dst_fd = os.open(tmp_path / "dst.bin", os.O_RDWR | os.O_CREAT)
+    try:
+        _run(network, lambda conn: conn.recvfile(dst_fd, 3000), lambda conn: conn.sendfile(src_fd))
+
+        os.fstat(src_fd)  # raises if either was closed
+        os.fstat(dst_fd)
+        assert os.pread(dst_fd, 3000, 0) == src.read_bytes()
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+
+
+@pytest.mark.parametrize('call', [
+    lambda conn, path: conn.sendfile(path, offset=-1),
+    lambda conn, path: conn.sendfile(path, count=-1),
+    lambda conn, path: conn.recvfile(path, 10, offset=-1),
+    lambda conn, path: conn.recvfile(path, -1),
+], ids=['sendfile offset', 'sendfile count', 'recvfile offset', 'recvfile count'])
+def test_negative_offset_or_count_is_rejected(tmp_path, call):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b'abc')
+    conn = TCPConnection(sock=None, addr=('cli', 400), remote_addr=('srv', 80), seq_number=0, ack_number=0)
+
+    with pytest.raises(ValueError):
+        call(conn, str(path))
+    assert path.read_bytes() == b'abc'
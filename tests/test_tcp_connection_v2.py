@@ -0,0 +1,37 @@
+import pytest
+
+from datagram import Datagram, TCPFlag
+from tcp_connection_v2 import Address, ConnectionContext, TCPEvent, TCPStateName
+from transport import SimulatedNetwork
+
+SERVER_ADDR = Address('srv', 80)
+CLIENT_ADDR = Address('cli', 400)
+
+
+def test_both_sides_reach_established():
+    network = SimulatedNetwork()
+    contexts = []
+
+    def server():
+        ctx = ConnectionContext(SERVER_ADDR, transport=network)
+        contexts.append(ctx)
+        ctx.listen()
+
+    def client():
+        network.sleep(0.1)
+        ctx = ConnectionContext(CLIENT_ADDR, transport=network)
+        contexts.append(ctx)
+        ctx.connect(SERVER_ADDR)
+
+    network.run(server, client)
+
+    assert [ctx.state_name for ctx in contexts] == [TCPStateName.ESTABLISHED, TCPStateName.ESTABLISHED]
+
+
+def test_unexpected_event_raises():
+    ctx = ConnectionContext(CLIENT_ADDR, transport=SimulatedNetwork())
+    ctx.set_state(TCPStateName.SYN_SENT)
+    ctx.post(TCPEvent.ACK, Datagram(80, 400, 0, 0, TCPFlag.ACK, b''))
+
+    with pytest.raises(Exception, match="Unexpected ACK in state SYN_SENT"):
+        ctx.run()
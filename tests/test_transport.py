@@ -0,0 +1,81 @@
+import random
+
+import capture
+from _tcp_connection import TCPConnector, TCPListener
+from tcp_connection.client import Connector
+from tcp_connection.server import ConnectionListener
+from tcp_connection.utils import Address
+from transport import SimulatedNetwork, udp_transport
+
+SERVER_ADDR = Address('srv', 80)
+CLIENT_ADDR = Address('cli', 400)
+
+
+def test_repeated_connections_between_the_same_endpoints():
+    network = SimulatedNetwork()
+    accepted = []
+    connected = []
+
+    def server():
+        listener = ConnectionListener(SERVER_ADDR, transport=network)
+        for _ in range(5):
+            accepted.append(listener.listen().accept())
+
+    def client():
+        network.sleep(0.1)
+        for _ in range(5):
+            connected.append(Connector(CLIENT_ADDR, transport=network).connect(SERVER_ADDR))
+            network.sleep(0.1)
+
+    network.run(server, client)
+
+    assert len(accepted) == 5
+    assert len(connected) == 5
+
+
+def test_same_seed_plays_out_the_same_way(tmp_path):
+    def traced_run(path):
+        network = SimulatedNetwork(seed=7)
+        capture.enable(path, clock=network.time)
+        try:
+            network.run(
+                lambda: ConnectionListener(SERVER_ADDR, fast_open=True, transport=network).listen().accept(),
+                lambda: (network.sleep(0.1), Connector(CLIENT_ADDR, fast_open=True, transport=network).connect(SERVER_ADDR))
+            )
+        finally:
+            capture.disable()
+        with open(path, 'rb') as f:
+            return f.read()
+
+    assert traced_run(str(tmp_path / "a.pcap")) == traced_run(str(tmp_path / "b.pcap"))
+
+
+def test_simulated_file_transfer(tmp_path):
+    network = SimulatedNetwork(latency=0.01)
+    src = tmp_path / "src.bin"
+    dst = tmp_path / "dst.bin"
+    src.write_bytes(bytes(range(256)) * 200)
+    received = []
+
+    def server():
+        listener = TCPListener('srv', 80, transport=network)
+        listener.listen()
+        conn = listener.accept()
+        received.append(conn.recvfile(str(dst), src.stat().st_size))
+
+    def client():
+        network.sleep(0.1)
+        TCPConnector('cli', 400, transport=network).connect(('srv', 80)).sendfile(str(src))
+
+    network.run(server, client)
+
+    assert received == [src.stat().st_size]
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_secrets_do_not_come_from_the_seeded_generator():
+    random.seed(0)
+    first = udp_transport.secret_bytes(16)
+    random.seed(0)
+    assert udp_transport.secret_bytes(16) != first
+    assert SimulatedNetwork(seed=3).secret_bytes(16) == SimulatedNetwork(seed=3).secret_bytes(16)
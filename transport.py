@@ -0,0 +1,295 @@
+"""
+Where connections get their sockets, threads and time from.
+
+`udp_transport` is the real thing. `SimulatedNetwork` is an in-process network on a virtual clock: every thread
+started with `spawn()` runs one at a time, and the clock jumps straight to the next delivery or timeout once all
+of them are blocked, so timeouts cost nothing. Randomness (`randbytes()`, `secret_bytes()`) and the default path
+metrics cache come from the transport too, so a simulated run with a given seed always plays out the same way.
+"""
+from __future__ import annotations
+
+import abc
+import errno
+import heapq
+import itertools
+import random
+import secrets
+import socket
+import threading
+import time
+import weakref
+from collections import deque
+from collections.abc import Callable
+
+import capture
+from tcp_connection.metrics import PathMetricsCache, path_metrics
+
+
+class Transport(abc.ABC):
+    path_metrics: PathMetricsCache  # default cache for connections made over this transport
+
+    @abc.abstractmethod
+    def socket(self) -> socket.socket:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def spawn(self, target: Callable[[], None], name: str | None = None) -> threading.Thread:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def time(self) -> float:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def sleep(self, seconds: float) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def randbytes(self, n: int) -> bytes:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def secret_bytes(self, n: int) -> bytes:
+        """Bytes nobody must be able to predict, e.g. keys."""
+        raise NotImplementedError
+
+
+class UDPTransport(Transport):
+    path_metrics = path_metrics
+
+    def socket(self) -> socket.socket:
+        return capture.wrap(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+
+    def spawn(self, target: Callable[[], None], name: str | None = None) -> threading.Thread:
+        thread = threading.Thread(target=target, name=name)
+        thread.start()
+        return thread
+
+    def time(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+    def randbytes(self, n: int) -> bytes:
+        return random.randbytes(n)
+
+    def secret_bytes(self, n: int) -> bytes:
+        return secrets.token_bytes(n)
+
+
+udp_transport = UDPTransport()
+
+
+class _Task:
+
+    def __init__(self, lock: threading.RLock):
+        self.turn = threading.Condition(lock)  # signalled when it's handed the baton
+        self.socket: SimulatedSocket | None = None  # what it's blocked on, None when just sleeping
+        self.deadline: float | None = None
+
+
+class SimulatedNetwork(Transport):
+
+    def __init__(self, latency: float = 0.001, loss: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.loss = loss
+        self._random = random.Random(seed)
+        self.path_metrics = PathMetricsCache(clock=self.time)
+        self._lock = threading.RLock()
+        self._now = 0.0
+        # held weakly so an address is freed once its socket is garbage collected, like a real one
+        self._sockets: weakref.WeakValueDictionary[tuple[str, int], SimulatedSocket] = weakref.WeakValueDictionary()
+        self._ports = itertools.count(49152)
+        self._order = itertools.count()
+        self._in_flight: list[tuple[float, int, tuple[str, int], bytes, tuple[str, int]]] = []  # heap by delivery time
+        self._tasks: dict[threading.Thread, _Task] = {}
+        self._runnable: deque[_Task] = deque()
+        self._waiting: list[_Task] = []
+        self._running: _Task | None = None
+        self._deadlocked = False
+
+    def socket(self) -> SimulatedSocket:
+        return capture.wrap(SimulatedSocket(self))
+
+    def spawn(self, target: Callable[[], None], name: str | None = None) -> threading.Thread:
+        task = _Task(self._lock)
+
+        def run():
+            with self._lock:
+                task.turn.wait_for(lambda: self._running is task)
+            try:
+                target()
+            finally:
+                with self._lock:
+                    del self._tasks[thread]
+                    self._running = None
+                    self._schedule()
+
+        thread = threading.Thread(target=run, name=name)
+        with self._lock:
+            self._tasks[thread] = task
+            self._runnable.append(task)
+            if self._running is None:
+                self._schedule()
+        thread.start()
+        return thread
+
+    def run(self, *targets: Callable[[], None]) -> None:
+        """Spawns every target and waits until all of them are done."""
+        with self._lock:  # none of them may run (and block) before all are spawned
+            threads = [self.spawn(target) for target in targets]
+        for thread in threads:
+            thread.join()
+
+    def time(self) -> float:
+        return self._now
+
+    def sleep(self, seconds: float) -> None:
+        with self._lock:
+            self._block(sock=None, deadline=self._now + seconds)
+
+    def randbytes(self, n: int) -> bytes:
+        with self._lock:
+            return self._random.randbytes(n)
+
+    def secret_bytes(self, n: int) -> bytes:
+        return self.randbytes(n)  # predictable on purpose, a simulated run has nothing to protect
+
+    def _bind(self, sock: SimulatedSocket, addr: tuple[str, int]) -> tuple[str, int]:
+        with self._lock:
+            if addr[1] == 0:
+                addr = (addr[0], next(self._ports))
+            if addr in self._sockets:
+                raise OSError(errno.EADDRINUSE, f"Address already in use: {addr}")
+            self._sockets[addr] = sock
+            return addr
+
+    def _unbind(self, sock: SimulatedSocket, addr: tuple[str, int]) -> None:
+        with self._lock:
+            if self._sockets.get(addr) is sock:
+                del self._sockets[addr]
+
+    def _send(self, payload: bytes, src: tuple[str, int], dst: tuple[str, int]) -> None:
+        with self._lock:
+            if self.loss and self._random.random() < self.loss:
+                return
+            heapq.heappush(self._in_flight, (self._now + self.latency, next(self._order), dst, payload, src))
+
+    def _receive(self, sock: SimulatedSocket) -> tuple[bytes, tuple[str, int]]:
+        with self._lock:
+            if not sock.inbox:
+                if sock.timeout == 0:
+                    raise BlockingIOError(errno.EAGAIN, "Resource temporarily unavailable")
+                deadline = None if sock.timeout is None else self._now + sock.timeout
+                self._block(sock=sock, deadline=deadline)
+                if not sock.inbox:
+                    raise socket.timeout("timed out")
+
+            return sock.inbox.popleft()
+
+    def _block(self, sock: SimulatedSocket | None, deadline: float | None) -> None:
+        task = self._tasks.get(threading.current_thread())
+        if task is None:
+            raise Exception("Only threads started with SimulatedNetwork.spawn() can block on the simulated network")
+
+        task.socket = sock
+        task.deadline = deadline
+        self._waiting.append(task)
+        self._running = None
+        self._schedule()
+        task.turn.wait_for(lambda: self._running is task or self._deadlocked)
+        if self._deadlocked:
+            raise Exception("Simulated network deadlocked - every task waits forever")
+
+    def _schedule(self) -> None:
+        """Hands the baton to the next runnable task, moving the clock forward until there is one."""
+        while not self._runnable and self._waiting:
+            self._wake_ready()
+            if self._runnable:
+                break
+
+            next_times = [task.deadline for task in self._waiting if task.deadline is not None]
+            if self._in_flight:
+                next_times.append(self._in_flight[0][0])
+            if not next_times:
+                self._deadlocked = True
+                for task in self._waiting:
+                    task.turn.notify()
+                return
+            self._now = max(self._now, min(next_times))
+
+        if self._runnable:
+            self._running = self._runnable.popleft()
+            self._running.turn.notify()
+
+    def _wake_ready(self) -> None:
+        while self._in_flight and self._in_flight[0][0] <= self._now:
+            _, _, dst, payload, src = heapq.heappop(self._in_flight)
+            sock = self._sockets.get(dst)
+            if sock is not None:
+                sock.inbox.append((payload, src))
+
+        still_waiting = []
+        for task in self._waiting:  # kept in the order they blocked, so wake-ups are deterministic
+            if task.socket is not None and task.socket.inbox or task.deadline is not None and task.deadline <= self._now:
+                task.socket = None  # don't keep the socket alive past the wait
+                self._runnable.append(task)
+            else:
+                still_waiting.append(task)
+        self._waiting = still_waiting
+
+
+class SimulatedSocket:
+
+    def __init__(self, network: SimulatedNetwork):
+        self._network = network
+        self._addr: tuple[str, int] | None = None
+        self.timeout: float | None = None
+        self.inbox: deque[tuple[bytes, tuple[str, int]]] = deque()
+
+    def bind(self, addr: tuple[str, int]) -> None:
+        self._addr = self._network._bind(self, addr)
+
+    def getsockname(self) -> tuple[str, int]:
+        return self._addr
+
+    def settimeout(self, value: float | None) -> None:
+        self.timeout = value
+
+    def gettimeout(self) -> float | None:
+        return self.timeout
+
+    def sendto(self, data: bytes, addr: tuple[str, int]) -> int:
+        if self._addr is None:
+            self.bind(('localhost', 0))
+        self._network._send(bytes(data), self._addr, tuple(addr))
+        return len(data)
+
+    def sendmsg(self, buffers, ancdata=(), flags: int = 0, address: tuple[str, int] | None = None) -> int:
+        return self.sendto(b''.join(buffers), address)
+
+    def recv(self, bufsize: int) -> bytes:
+        payload, _ = self.recvfrom(bufsize)
+        return payload
+
+    def recvfrom(self, bufsize: int) -> tuple[bytes, tuple[str, int]]:
+        payload, addr = self._network._receive(self)
+        return payload[:bufsize], addr
+
+    def recvmsg_into(self, buffers, ancbufsize: int = 0, flags: int = 0):
+        payload, addr = self._network._receive(self)
+        pos = 0
+        for buffer in buffers:
+            view = memoryview(buffer).cast('B')
+            size = min(len(view), len(payload) - pos)
+            view[:size] = payload[pos:pos + size]
+            pos += size
+
+        msg_flags = socket.MSG_TRUNC if pos < len(payload) else 0
+        return pos, [], msg_flags, addr
+
+    def close(self) -> None:
+        if self._addr is not None:
+            self._network._unbind(self, self._addr)
+            self._addr = None